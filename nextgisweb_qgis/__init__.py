@@ -1,2 +1,8 @@
 from .component import QgisComponent
-from .model import QgisRasterStyle, QgisStyleFormat, QgisVectorStyle, update_not_modified
+from .model import (
+    QgisRasterStyle,
+    QgisStyleFormat,
+    QgisVectorStyle,
+    render_composite,
+    update_not_modified,
+)
@@ -7,7 +7,9 @@ from nextgisweb.env import gettext
 from nextgisweb.core.exception import ValidationError
 from nextgisweb.resource import ResourceScope, resource_factory
 
+from .cache import StyleCacheStats
 from .model import QgisRasterStyle, QgisStyleFormat, QgisVectorStyle, read_style
+from .timing import RenderStatsItem
 
 
 class OriginalEnum(Enum):
@@ -45,6 +47,21 @@ def style_qml(
     return response
 
 
+def style_cache_stats(request) -> StyleCacheStats:
+    """Read parsed style cache statistics"""
+    request.require_administrator()
+    return request.env.qgis.style_cache.stats()
+
+
+def render_stats(request) -> dict[int, RenderStatsItem]:
+    """Read render timing statistics by style
+
+    Statistics are collected per process, so only renders made by the
+    process handling the request are included."""
+    request.require_administrator()
+    return request.env.qgis.render_stats.stats()
+
+
 def setup_pyramid(comp, config):
     route = config.add_route(
         "qgis.style_qml",
@@ -55,3 +72,13 @@ def setup_pyramid(comp, config):
 
     route.add_view(style_qml, context=QgisVectorStyle, request_method="GET")
     route.add_view(style_qml, context=QgisRasterStyle, request_method="GET")
+
+    config.add_route(
+        "qgis.style_cache",
+        "/api/component/qgis/style_cache",
+    ).add_view(style_cache_stats, request_method="GET")
+
+    config.add_route(
+        "qgis.render_stats",
+        "/api/component/qgis/render_stats",
+    ).add_view(render_stats, request_method="GET")
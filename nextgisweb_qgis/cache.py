@@ -0,0 +1,189 @@
+from concurrent.futures import Future
+from threading import Lock
+from time import perf_counter
+
+from cachetools import LRUCache, TTLCache
+from msgspec import Struct
+
+MISSING = object()
+
+# Estimated memory consumed by a parsed style regardless of its source
+STYLE_SIZE_OVERHEAD = 16 * 2**10
+
+# Maximum number of values derived from a single style
+DERIVED_MAXSIZE = 32
+
+
+class RenderCache(TTLCache):
+    """LRU cache with expiring entries guarded by a lock"""
+
+    def __init__(self, maxsize, ttl):
+        super().__init__(maxsize=maxsize, ttl=ttl)
+        self.lock = Lock()
+
+
+class SingleFlight:
+    """Coalescing of concurrent calls with the same key
+
+    Only the first caller runs the function, others wait for its result or
+    exception. Only threads of the current process are coalesced. If results
+    are mutable, a copy function can be given, so waiting callers get their
+    own copies of the result."""
+
+    def __init__(self, copy=None):
+        self._lock = Lock()
+        self._calls = dict()
+        self._copy = copy
+
+    def __call__(self, key, fn, *args, **kwargs):
+        with self._lock:
+            future = self._calls.get(key)
+            if leader := future is None:
+                future = self._calls[key] = Future()
+
+        if not leader:
+            result = future.result()
+            return result if self._copy is None else self._copy(result)
+
+        try:
+            result = fn(*args, **kwargs)
+        except BaseException as exc:
+            future.set_exception(exc)
+            raise
+        else:
+            future.set_result(result)
+            return result
+        finally:
+            with self._lock:
+                del self._calls[key]
+
+
+class StyleCacheEntry:
+    __slots__ = ("style", "size", "_derived", "_lock", "_resize")
+
+    def __init__(self, style, size, resize=None):
+        self.style = style
+        self.size = size
+        self._derived = LRUCache(maxsize=DERIVED_MAXSIZE)
+        self._lock = Lock()
+        self._resize = resize
+
+    def derive(self, name, fn, *, sizeof=None):
+        """Get a value computed from the style and cached along with it
+
+        Derived values share the style entry lifetime, so they are dropped
+        when the style is evicted or its cache key changes on update. Only a
+        limited number of recently used values is kept, and sizes of values
+        returned by sizeof() are added to the entry size."""
+
+        with self._lock:
+            if (item := self._derived.get(name)) is not None:
+                return item[0]
+
+        value = fn(self.style)
+        size = 0 if sizeof is None else sizeof(value)
+
+        with self._lock:
+            if name in self._derived:
+                return value
+            if len(self._derived) >= self._derived.maxsize:
+                _, (_, evicted_size) = self._derived.popitem()
+                self.size -= evicted_size
+            self._derived[name] = (value, size)
+            self.size += size
+
+        if size > 0 and self._resize is not None:
+            self._resize(self)
+        return value
+
+
+class StyleCacheStats(Struct, kw_only=True):
+    entries: int
+    size: int
+    maxsize: int
+    hits: int
+    misses: int
+    evictions: int
+    parse_time: float
+
+
+class _EntryCache(LRUCache):
+    def __init__(self, maxsize):
+        super().__init__(maxsize=maxsize, getsizeof=lambda entry: entry.size)
+        self.evictions = 0
+
+    def popitem(self):
+        result = super().popitem()
+        self.evictions += 1
+        return result
+
+
+class StyleCache:
+    """Thread-safe LRU cache of parsed styles bounded by estimated size
+
+    Concurrent requests for a missing key are coalesced, so each style is
+    parsed once. Styles larger than the whole cache aren't cached."""
+
+    def __init__(self, maxsize):
+        self._cache = _EntryCache(maxsize)
+        self._lock = Lock()
+        self._flight = SingleFlight()
+
+        self.hits = 0
+        self.misses = 0
+        self.parse_time = 0.0
+
+    def get(self, key, load):
+        """Get a cache entry or create it from the (style, size) tuple
+        returned by load()"""
+
+        with self._lock:
+            if (entry := self._cache.get(key)) is not None:
+                self.hits += 1
+                return entry
+            self.misses += 1
+
+        return self._flight(key, self._load, key, load)
+
+    def _load(self, key, load):
+        start = perf_counter()
+        style, size = load()
+        entry = StyleCacheEntry(style, size, lambda entry: self._resize(key, entry))
+        elapsed = perf_counter() - start
+
+        with self._lock:
+            self.parse_time += elapsed
+            if entry.size <= self._cache.maxsize:
+                self._cache[key] = entry
+
+        return entry
+
+    def _resize(self, key, entry):
+        with self._lock:
+            if self._cache.get(key) is not entry:
+                return
+
+            # Reinsert the entry to account its new size, which may evict
+            # other entries or the entry itself if it doesn't fit anymore
+            del self._cache[key]
+            if entry.size <= self._cache.maxsize:
+                self._cache[key] = entry
+
+    def clear(self):
+        with self._lock:
+            # Clearing isn't an eviction, keep the counter as is
+            evictions = self._cache.evictions
+            self._cache.clear()
+            self._cache.evictions = evictions
+
+    def stats(self):
+        with self._lock:
+            return StyleCacheStats(
+                entries=len(self._cache),
+                size=self._cache.currsize,
+                maxsize=self._cache.maxsize,
+                hits=self.hits,
+                misses=self.misses,
+                evictions=self._cache.evictions,
+                parse_time=self.parse_time,
+            )
@@ -1,12 +1,25 @@
+import os
+import sys
+import tempfile
+from datetime import timedelta
+from hashlib import md5
+from importlib.metadata import version as package_version
+from pathlib import Path
+from stat import S_IMODE, S_ISDIR
+
 import transaction
 
 from nextgisweb.env import Component
-from nextgisweb.lib.config import Option, OptionAnnotations
+from nextgisweb.lib.config import Option, OptionAnnotations, SizeInBytes
 from nextgisweb.lib.logging import logger
 
 import qgis_headless as qh
 
-from .model import QgisRasterStyle, QgisVectorStyle
+from .cache import RenderCache, SingleFlight, StyleCache
+from .model import QgisRasterStyle, QgisStyleFormat, QgisVectorStyle
+from .pool import RenderPool
+from .snapshot import SnapshotCache
+from .timing import RenderStats
 
 
 class QgisComponent(Component):
@@ -14,9 +27,87 @@ class QgisComponent(Component):
         super(QgisComponent, self).initialize()
         self._qgis_initialized = False
 
+        self.style_cache = StyleCache(self.options["style_cache.size"])
+        self.metatile_cache = RenderCache(
+            maxsize=self.options["metatile.cache_size"],
+            ttl=self.options["metatile.ttl"].total_seconds(),
+        )
+        self.empty_cache = RenderCache(
+            maxsize=self.options["empty_cache.size"],
+            ttl=self.options["empty_cache.ttl"].total_seconds(),
+        )
+        self.render_flight = SingleFlight(copy=lambda im: None if im is None else im.copy())
+        self.raster_cache = RenderCache(
+            maxsize=self.options["raster_cache.size"],
+            ttl=self.options["raster_cache.ttl"].total_seconds(),
+        )
+        self.render_stats = RenderStats()
+        self.filter_cache = RenderCache(
+            maxsize=self.options["filter_cache.size"],
+            ttl=self.options["filter_cache.ttl"].total_seconds(),
+        )
+
+        self.snapshot_cache = None
+        if (snapshot_size := self.options["snapshot.size"]) > 0:
+            self.snapshot_cache = SnapshotCache(
+                snapshot_size,
+                self.options["snapshot.ttl"].total_seconds(),
+                threshold=self.options["snapshot.threshold"],
+                max_features=self.options["snapshot.max_features"],
+                max_tracked=self.options["snapshot.max_tracked"],
+            )
+
     def configure(self):
         super(QgisComponent, self).configure()
 
+        self.render_pool = None
+        if (pool_size := self.options["pool.size"]) > 0:
+            self.render_pool = RenderPool(
+                self._pool_address(),
+                size=pool_size,
+                timeout=self.options["pool.timeout"].total_seconds(),
+                executable=self.options["pool.executable"],
+                logging_level=self._logging_level(),
+                svg_path=self.options["svg_path"] if "svg_path" in self.options else None,
+            )
+
+    def _pool_address(self):
+        if (address := self.options["pool.socket"]) is not None:
+            return address
+
+        # Instances with different configurations must not share a server,
+        # and a server started by a previous version or with other settings
+        # must not be reused after an upgrade or a configuration change.
+        svg_path = self.options["svg_path"] if "svg_path" in self.options else None
+        token = "\n".join(
+            (
+                sys.prefix,
+                os.environ.get("NEXTGISWEB_CONFIG", ""),
+                package_version("nextgisweb_qgis"),
+                repr(svg_path),
+                self._logging_level(),
+                str(self.options["pool.size"]),
+                str(self.options["pool.executable"]),
+            )
+        )
+
+        # Jobs and results are unpickled on both sides, so the socket must be
+        # in a directory accessible by the current user only.
+        if runtime_dir := os.environ.get("XDG_RUNTIME_DIR"):
+            dirname = Path(runtime_dir) / "nextgisweb-qgis"
+        else:
+            dirname = Path(tempfile.gettempdir()) / f"nextgisweb-qgis-{os.getuid()}"
+        dirname.mkdir(mode=0o700, exist_ok=True)
+
+        st = os.lstat(dirname)
+        if not S_ISDIR(st.st_mode) or st.st_uid != os.getuid() or S_IMODE(st.st_mode) != 0o700:
+            raise RuntimeError(
+                f"Render server directory {dirname} must be owned by the current "
+                "user and accessible by this user only."
+            )
+
+        return str(dirname / f"{md5(token.encode()).hexdigest()[:12]}.sock")
+
     def setup_pyramid(self, config):
         super(QgisComponent, self).setup_pyramid(config)
 
@@ -28,16 +119,17 @@ class QgisComponent(Component):
     def sys_info(self):
         return (("QGIS", qh.get_qgis_version()),)
 
+    def _logging_level(self):
+        # Default is CRITICAL in production mode and INFO in development mode
+        logging_level = self.options["logging_level"]
+        if logging_level is None:
+            return "INFO" if self.env.core.debug else "CRITICAL"
+        return logging_level.upper()
+
     def qgis_init(self):
         if not self._qgis_initialized:
-            # Set up logging level before initialization. Default is CRITICAL in
-            # production mode and INFO in development mode.
-            logging_level = self.options["logging_level"]
-            if logging_level is None:
-                logging_level = "INFO" if self.env.core.debug else "CRITICAL"
-            else:
-                logging_level = logging_level.upper()
-            qh.set_logging_level(getattr(qh.LogLevel, logging_level))
+            # Set up logging level before initialization
+            qh.set_logging_level(getattr(qh.LogLevel, self._logging_level()))
 
             qh.init([])
 
@@ -48,6 +140,15 @@ class QgisComponent(Component):
     def maintenance(self):
         with transaction.manager:
             for cls in (QgisRasterStyle, QgisVectorStyle):
+                for resource in cls.filter(
+                    cls.qgis_content_hash.is_(None),
+                    cls.qgis_format != QgisStyleFormat.DEFAULT,
+                ):
+                    try:
+                        resource._update_content_hash()
+                    except FileNotFoundError as e:
+                        logger.warning(f"QGIS style (id={resource.id}) error: {e}")
+
                 for resource in cls.filter_by(qgis_scale_range_cache=None):
                     try:
                         resource._update_scale_range_cache()
@@ -59,6 +160,65 @@ class QgisComponent(Component):
         Option("svg_path", list, doc="Search paths for SVG icons."),
         Option("default_style", bool, default=True),
         Option("logging_level", str, default=None),
+        Option("style_cache.size", SizeInBytes, default=256 * 2**20, doc=(
+            "Memory budget for parsed styles estimated by style sources size.")),
+        Option("metatile.size", int, default=1, doc=(
+            "Number of tiles along each side of a metatile rendered at once "
+            "for vector styles. Metatiling is disabled when set to 1.")),
+        Option("metatile.cache_size", int, default=1024, doc=(
+            "Maximum number of rendered tiles waiting for sibling requests.")),
+        Option("metatile.ttl", timedelta, default=timedelta(seconds=60), doc=(
+            "Time to keep rendered tiles waiting for sibling requests. Tiles "
+            "are keyed by the persisted layer data version, so data changes "
+            "made in any process invalidate them.")),
+        Option("empty_cache.size", int, default=65536, doc=(
+            "Maximum number of remembered empty render results.")),
+        Option("empty_cache.ttl", timedelta, default=timedelta(seconds=30), doc=(
+            "Time to remember empty render results. Results are keyed by the "
+            "persisted layer data version, so data changes made in any "
+            "process invalidate them.")),
+        Option("raster_cache.size", int, default=64, doc=(
+            "Maximum number of rasters with resolved paths, footprints and "
+            "opened QGIS layers kept for rendering.")),
+        Option("raster_cache.ttl", timedelta, default=timedelta(hours=1), doc=(
+            "Time to keep resolved raster paths, footprints and opened QGIS "
+            "layers for rendering.")),
+        Option("simplify.tolerance", float, default=None, doc=(
+            "Simplify line and polygon geometries before rendering with the "
+            "given tolerance in pixels, for example 0.5. Disabled by default.")),
+        Option("filter_cache.size", int, default=1024, doc=(
+            "Maximum number of parsed feature filters kept for rendering.")),
+        Option("filter_cache.ttl", timedelta, default=timedelta(hours=1), doc=(
+            "Time to keep parsed feature filters for rendering.")),
+        Option("snapshot.size", SizeInBytes, default=0, doc=(
+            "Memory budget for in-memory feature snapshots of frequently "
+            "rendered vector layers. Snapshots are disabled when set to 0.")),
+        Option("snapshot.threshold", int, default=64, doc=(
+            "Number of renders of a layer within the snapshot TTL after which "
+            "the layer snapshot is created.")),
+        Option("snapshot.max_features", int, default=100000, doc=(
+            "Maximum number of features in a layer eligible for a snapshot.")),
+        Option("snapshot.max_tracked", int, default=4096, doc=(
+            "Maximum number of layers with renders counted for snapshots.")),
+        Option("snapshot.ttl", timedelta, default=timedelta(minutes=10), doc=(
+            "Time to keep feature snapshots. Snapshots are keyed by the "
+            "persisted layer data version, so data changes made in any "
+            "process invalidate them.")),
+        Option("pool.size", int, default=0, doc=(
+            "Number of dedicated processes for QGIS rendering shared by all "
+            "processes of the host. Rendering is performed in the serving "
+            "process when set to 0.")),
+        Option("pool.socket", str, default=None, doc=(
+            "Unix socket path of the render server. By default, it's created "
+            "in a private runtime or temporary directory and depends on the "
+            "configuration and the package version.")),
+        Option("pool.timeout", timedelta, default=timedelta(seconds=60), doc=(
+            "Maximum time to wait for a render process result.")),
+        Option("pool.executable", str, default=None, doc=(
+            "Python interpreter for render processes, required when running "
+            "under an embedding server like uWSGI.")),
+        Option("timing.server_timing", bool, default=False, doc=(
+            "Add durations of QGIS render phases to Server-Timing header.")),
         Option("test.qgis_headless_path", str, default=None, doc=(
             "Path to QGIS headless package for loading test data.")),
     ))
@@ -0,0 +1,8 @@
+/*** {
+    "revision": "5c2e8a41", "parents": ["49d19279"],
+    "date": "2026-10-17T09:12:44",
+    "message": "Content hash"
+} ***/
+
+ALTER TABLE qgis_raster_style ADD COLUMN qgis_content_hash character varying(32);
+ALTER TABLE qgis_vector_style ADD COLUMN qgis_content_hash character varying(32);
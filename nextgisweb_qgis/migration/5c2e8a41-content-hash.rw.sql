@@ -0,0 +1,4 @@
+/*** { "revision": "5c2e8a41" } ***/
+
+ALTER TABLE qgis_raster_style DROP COLUMN qgis_content_hash;
+ALTER TABLE qgis_vector_style DROP COLUMN qgis_content_hash;
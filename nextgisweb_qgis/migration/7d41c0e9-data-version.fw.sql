@@ -0,0 +1,14 @@
+/*** {
+    "revision": "7d41c0e9", "parents": ["5c2e8a41"],
+    "date": "2026-10-17T14:05:12",
+    "message": "Data version"
+} ***/
+
+CREATE TABLE qgis_data_version (
+    resource_id integer NOT NULL,
+    version integer NOT NULL,
+    PRIMARY KEY (resource_id),
+    FOREIGN KEY (resource_id) REFERENCES resource (id) ON DELETE CASCADE
+);
+
+COMMENT ON TABLE qgis_data_version IS 'qgis';
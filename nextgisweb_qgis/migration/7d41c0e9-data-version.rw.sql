@@ -0,0 +1,3 @@
+/*** { "revision": "7d41c0e9" } ***/
+
+DROP TABLE qgis_data_version;
@@ -1,29 +1,43 @@
 import re
+from collections import defaultdict
+from contextlib import ExitStack, contextmanager
 from enum import Enum
+from hashlib import md5
 from io import BytesIO
-from os.path import normpath
+from itertools import batched
+from math import ceil
+from operator import itemgetter
+from os.path import getsize, normpath
 from os.path import sep as path_sep
 from textwrap import dedent
+from threading import Lock
 from typing import Union
 from uuid import UUID
 
 import sqlalchemy as sa
 import sqlalchemy.orm as orm
-from cachetools import LRUCache
 from msgspec import UNSET, Struct, UnsetType
+from osgeo import gdal
 from qgis_headless.util import to_pil as qgis_image_to_pil
-from shapely.geometry import box
+from shapely.geometry import Polygon, box
+from sqlalchemy.dialects.postgresql import insert as pg_insert
 from sqlalchemy.orm import Mapped, declared_attr, mapped_column
 from zope.interface import implementer
 
-from nextgisweb.env import env, gettext
+from nextgisweb.env import Base, DBSession, env, gettext
 from nextgisweb.lib import saext
-from nextgisweb.lib.geometry import Geometry
+from nextgisweb.lib.geometry import Geometry, Transformer
 from nextgisweb.lib.json import dumps as json_dumps
 from nextgisweb.lib.saext import Msgspec
 
 from nextgisweb.core.exception import InsufficientPermissions, OperationalError, ValidationError
-from nextgisweb.feature_layer import FIELD_TYPE, GEOM_TYPE, IFeatureLayer, IFilterableFeatureLayer
+from nextgisweb.feature_layer import (
+    FIELD_TYPE,
+    GEOM_TYPE,
+    IFeatureLayer,
+    IFeatureQuerySimplify,
+    IFilterableFeatureLayer,
+)
 from nextgisweb.file_storage import FileObj
 from nextgisweb.file_upload import FileUploadRef
 from nextgisweb.render import (
@@ -35,6 +49,7 @@ from nextgisweb.render import (
     ITileRenderRequest,
     LegendSymbol,
 )
+from nextgisweb.render.event import on_data_change
 from nextgisweb.resmeta import ResourceMetadataItem
 from nextgisweb.resource import (
     DataScope,
@@ -61,8 +76,14 @@ from qgis_headless import (
     StyleValidationError,
 )
 
+from .cache import MISSING, STYLE_SIZE_OVERHEAD
+from .pool import RasterSource, RenderJob, VectorSource
+from .qml import ExpressionError, rule_filter, symbol_extent, symbol_filter
+from .timing import add_server_timing, count_features, render_phase, render_timing
 from .util import (
     MD5_NULL_HEXDIGEST,
+    bgra_to_pil,
+    bgra_transparent,
     file_md5_hexdigest,
     rand_color,
     sld_fix_vector,
@@ -84,6 +105,13 @@ _GEOM_TYPE_TO_QGIS = {
     GEOM_TYPE.MULTIPOLYGONZ: Layer.GT_MULTIPOLYGONZ,
 }
 
+_POINT_GEOM_TYPES = (
+    GEOM_TYPE.POINT,
+    GEOM_TYPE.MULTIPOINT,
+    GEOM_TYPE.POINTZ,
+    GEOM_TYPE.MULTIPOINTZ,
+)
+
 STRIP_SVG_PATH = re.compile(
     r"^(/usr/share/qgis/svg/|/Users/[^/]+/|/home/[^/]+/|(../)+|/)", re.IGNORECASE
 )
@@ -103,6 +131,64 @@ _FILE_FORMAT_2_HEADLESS = {
 _HEADLESS_2_FILE_FORMAT = {v: k for k, v in _FILE_FORMAT_2_HEADLESS.items()}
 
 
+PADDING_AUTO = "auto"
+PADDING_DEFAULT = 64
+PADDING_MAX = 256
+
+# Extra pixels for antialiasing
+PADDING_EXTRA = 2
+
+
+def _auto_padding(style_entry, extent, size):
+    # Symbol extents are extracted once per parsed style
+    sym_extent = style_entry.derive(
+        "symbol_extent",
+        lambda style: symbol_extent(style.to_string()),
+    )
+    pixels = sym_extent.pixels((extent[2] - extent[0]) / size[0])
+    if pixels is None:
+        return PADDING_DEFAULT
+
+    padding = min(ceil(pixels) + PADDING_EXTRA, PADDING_MAX)
+    if sym_extent.labels:
+        # Label sizes are unknown, but they shouldn't be clipped too much
+        padding = max(padding, PADDING_DEFAULT)
+    return padding
+
+
+def _tile_blocks(tiles):
+    """Group tiles into rectangular blocks of adjacent tiles
+
+    Returns lists of tile indexes. Rows of adjacent tiles are joined with
+    the preceding row if it has the same span."""
+
+    positions = defaultdict(list)
+    for i, (z, x, y) in enumerate(tiles):
+        positions[(y, x)].append(i)
+
+    # Runs of adjacent tiles within rows
+    runs = list()
+    for y, x in sorted(positions):
+        run = runs[-1] if runs else None
+        if run is not None and run[0] == y and run[2] == x - 1:
+            run[2] = x
+            run[3].extend(positions[(y, x)])
+        else:
+            runs.append([y, x, x, list(positions[(y, x)])])
+
+    blocks = list()
+    open_blocks = dict()
+    for y, x0, x1, indexes in runs:
+        block = open_blocks.get((x0, x1))
+        if block is not None and block[0] == y - 1:
+            block[0] = y
+            block[1].extend(indexes)
+        else:
+            open_blocks[(x0, x1)] = [y, indexes]
+            blocks.append(indexes)
+    return blocks
+
+
 def _render_bounds(extent, size, padding):
     res_x = (extent[2] - extent[0]) / size[0]
     res_y = (extent[3] - extent[1]) / size[1]
@@ -124,10 +210,22 @@ def _render_bounds(extent, size, padding):
     return extended, render_size, target_box
 
 
+_FEATURE_BATCH_SIZE = 1024
+
+# Estimated memory consumed by a legend symbol besides its icon
+LEGEND_SYMBOL_SIZE_OVERHEAD = 256
+
+# Maximum number of idle QGIS layers kept per raster
+RASTER_LAYERS_MAXSIZE = 4
+
+
 class ScaleRangeCache(Struct, array_like=True):
     min_scale_denom: Union[float, None]
     max_scale_denom: Union[float, None]
 
+    def scale_range(self):
+        return (self.min_scale_denom, self.max_scale_denom)
+
 
 class QgisStyleMixin:
     @declared_attr
@@ -156,6 +254,10 @@ class QgisStyleMixin:
     def qgis_scale_range_cache(cls):
         return sa.Column(Msgspec(ScaleRangeCache), nullable=True)
 
+    @declared_attr
+    def qgis_content_hash(cls):
+        return sa.Column(sa.Unicode(32), nullable=True)
+
     @classmethod
     def _qgis_format_check(cls):
         sql = """
@@ -173,6 +275,17 @@ class QgisStyleMixin:
     def srs(self):
         return self.parent.srs
 
+    def _render_job(self, style, srs, source, extent, size, symbols=None):
+        return RenderJob(
+            srid=srs.id,
+            style_key=_cache_key(self),
+            style_xml=read_style_entry(self).derive("xml", Style.to_string, sizeof=len),
+            source=source,
+            extent=tuple(extent),
+            size=tuple(size),
+            symbols=symbols,
+        )
+
     def from_file(self, filename, *, format_=QgisStyleFormat.QML_FILE):
         self.qgis_format = format_
         self.qgis_fileobj = FileObj().copy_from(filename)
@@ -183,11 +296,27 @@ class QgisStyleMixin:
         sr = read_style(self).scale_range()
         self.qgis_scale_range_cache = ScaleRangeCache(*sr)
 
+    def _update_content_hash(self):
+        # MD5 digest is compatible with update_not_modified metadata
+        if self.qgis_format == QgisStyleFormat.DEFAULT:
+            self.qgis_content_hash = None
+        elif self.qgis_format == QgisStyleFormat.SLD:
+            self.qgis_content_hash = md5(self.qgis_sld.to_xml().encode("utf-8")).hexdigest()
+        else:
+            filename = env.file_storage.filename(self.qgis_fileobj)
+            self.qgis_content_hash = file_md5_hexdigest(filename)
+
     def scale_range(self):
         if self.qgis_scale_range_cache is None:
             self._update_scale_range_cache()
-        c = self.qgis_scale_range_cache
-        return (c.min_scale_denom, c.max_scale_denom)
+        return self.qgis_scale_range_cache.scale_range()
+
+    def _check_scale_range_cache(self, extent, size, *, dpi):
+        # Persisted scale range allows rejecting requests without reading the
+        # style and initializing QGIS. Missing cache is checked after reading.
+        if (c := self.qgis_scale_range_cache) is None:
+            return True
+        return check_scale_range(c, extent, size, dpi=dpi)
 
 
 def update_not_modified(
@@ -215,7 +344,8 @@ def update_not_modified(
             return False
         else:
             assert resource.qgis_fileobj, f"Missing qgis_fileobj, {resource.qgis_format=}"
-            hash_existing = file_md5_hexdigest(resource.qgis_fileobj.filename())
+            if (hash_existing := resource.qgis_content_hash) is None:
+                hash_existing = file_md5_hexdigest(resource.qgis_fileobj.filename())
         update = hash_existing == hash_expected
 
     if not update:
@@ -232,6 +362,7 @@ def update_not_modified(
 
         resource.qgis_format = format
         resource.qgis_fileobj = FileObj().copy_from(source)
+        resource.qgis_content_hash = hash_new
 
     for rmi in resource.resmeta:
         if rmi.key == resmeta:
@@ -262,10 +393,9 @@ class QgisRasterStyle(Resource, QgisStyleMixin):
     def render_request(self, srs, cond=None):
         return RenderRequest(self, srs)
 
-    def _qgis_layer(self):
+    def _gdal_path(self):
         parent = self.parent
         if parent.storage is not None:
-            parent.storage.configure_gdal()
             gdal_path = parent.storage.vsi_path(parent.storage_filename)
         else:
             # We need raster pyramids so use working directory filename instead of
@@ -274,39 +404,125 @@ class QgisRasterStyle(Resource, QgisStyleMixin):
                 parent.fileobj,
                 parent.fileobj_pam,
             )
-        return Layer.from_gdal(str(gdal_path))
+        return str(gdal_path)
+
+    def _raster_key(self):
+        parent = self.parent
+        return (
+            parent.id,
+            parent.fileobj_id,
+            parent.storage_filename if parent.storage is not None else None,
+            _data_version(parent),
+        )
+
+    def _raster_entry(self):
+        # Dataset paths, footprints and opened QGIS layers are reused until the
+        # raster data changes. Storage configuration sets process-wide GDAL
+        # options, which can be changed by other storages or refreshed since
+        # the entry was created, so it's applied on each use.
+        parent = self.parent
+        if parent.storage is not None:
+            parent.storage.configure_gdal()
+
+        key = self._raster_key()
+
+        cache = env.qgis.raster_cache
+        with cache.lock:
+            if (entry := cache.get(key)) is not None:
+                return entry
+
+        entry = _RasterEntry(path=self._gdal_path())
+        with cache.lock:
+            entry = cache.setdefault(key, entry)
+        return entry
+
+    def _qgis_layer(self):
+        """Context manager borrowing a QGIS layer of the raster"""
+        return self._raster_entry().borrow_layer()
+
+    def _footprint(self, srs):
+        entry = self._raster_entry()
+        with entry.lock:
+            footprint = entry.footprints.get(srs.id, MISSING)
+
+        if footprint is MISSING:
+            footprint = _raster_footprint(entry.path, self.parent.srs, srs)
+            with entry.lock:
+                entry.footprints[srs.id] = footprint
+
+        return footprint
+
+    def _render_style(self, srs, extent, size):
+        """Parsed style if something can be rendered within the extent"""
+
+        if not self._check_scale_range_cache(extent, size, dpi=96):
+            return None
+
+        footprint = self._footprint(srs)
+        if footprint is not None and not footprint.intersects(box(*extent)):
+            return None
 
-    def _render_image(self, srs, extent, size):
         env.qgis.qgis_init()
 
         style = read_style(self)
-        if not check_scale_range(style, extent, size, dpi=96):
+        if self.qgis_scale_range_cache is None and not check_scale_range(
+            style, extent, size, dpi=96
+        ):
             return None
 
+        return style
+
+    def _render_image(self, srs, extent, size):
+        with render_phase("style"):
+            style = self._render_style(srs, extent, size)
+        if style is None:
+            return None
+
+        pool = env.qgis.render_pool
+        if pool is not None and self.parent.storage is None:
+            # Rasters from external storages require GDAL configuration, which
+            # is only available in this process.
+            source = RasterSource(path=self._raster_entry().path)
+            with render_phase("render"):
+                return pool.render(self._render_job(style, srs, source, extent, size))
+
         mreq = MapRequest()
         mreq.set_dpi(96)
         mreq.set_crs(CRS.from_epsg(srs.id))
 
-        layer = self._qgis_layer()
-        mreq.add_layer(layer, style)
-
-        res = mreq.render_image(extent, size)
-        img = qgis_image_to_pil(res)
+        with self._qgis_layer() as layer:
+            mreq.add_layer(layer, style)
+            with render_phase("render"):
+                res = mreq.render_image(extent, size)
 
-        return img
+        with render_phase("image"):
+            return _render_result_to_pil(res)
 
     def legend_symbols(self, icon_size):
         env.qgis.qgis_init()
 
+        # Band titles depend on the raster, which isn't a part of the style key
+        parent = self.parent
+        key = ("legend_symbols", icon_size, parent.id, parent.fileobj_id)
+        entry = read_style_entry(self)
+        return list(
+            entry.derive(
+                key,
+                lambda style: self._legend_symbols(style, icon_size),
+                sizeof=_legend_symbols_size,
+            )
+        )
+
+    def _legend_symbols(self, style, icon_size):
         mreq = MapRequest()
         mreq.set_dpi(96)
 
-        style = read_style(self)
-        layer = self._qgis_layer()
-        mreq.add_layer(layer, style)
+        with self._qgis_layer() as layer:
+            mreq.add_layer(layer, style)
+            symbols = mreq.legend_symbols(0, (icon_size, icon_size))
 
         result = []
-        for s in mreq.legend_symbols(0, (icon_size, icon_size)):
+        for s in symbols:
             if title := s.title():
                 dn = title
             else:
@@ -328,6 +544,61 @@ class QgisRasterStyle(Resource, QgisStyleMixin):
         )
 
 
+class _RasterEntry:
+    __slots__ = ("path", "footprints", "layers", "lock")
+
+    def __init__(self, path):
+        self.path = path
+        self.footprints = dict()
+        self.layers = list()
+        self.lock = Lock()
+
+    @contextmanager
+    def borrow_layer(self):
+        # A QGIS layer is used by a single map request at a time, so each
+        # render takes an idle layer or opens a new one. Layers are returned
+        # only after a successful render.
+        with self.lock:
+            layer = self.layers.pop() if len(self.layers) > 0 else None
+        if layer is None:
+            with render_phase("layer"):
+                layer = Layer.from_gdal(self.path)
+
+        yield layer
+
+        with self.lock:
+            if len(self.layers) < RASTER_LAYERS_MAXSIZE:
+                self.layers.append(layer)
+
+
+def _raster_footprint(gdal_path, raster_srs, srs):
+    ds = gdal.Open(gdal_path)
+    if ds is None:
+        return None
+
+    gt = ds.GetGeoTransform()
+    xsize, ysize = ds.RasterXSize, ds.RasterYSize
+    corners = [
+        (gt[0] + px * gt[1] + py * gt[2], gt[3] + px * gt[4] + py * gt[5])
+        for px, py in ((0, 0), (xsize, 0), (xsize, ysize), (0, ysize))
+    ]
+    footprint = Polygon(corners)
+    if raster_srs.id == srs.id:
+        return footprint
+
+    # Densify edges to follow their curvature after reprojection
+    minx, miny, maxx, maxy = footprint.bounds
+    footprint = footprint.segmentize(max(maxx - minx, maxy - miny) / 32)
+
+    try:
+        transformer = Transformer(raster_srs.wkt, srs.wkt)
+        return transformer.transform(Geometry.from_shape(footprint, srid=None)).shape
+    except Exception:
+        # Footprint may be not representable in the target SRS, for example,
+        # polar areas in Web Mercator. Skip the check in this case.
+        return None
+
+
 def path_resolver_factory(svg_marker_library):
     def path_resolver(name):
         if name.startswith(("http://", "https://", "base64:")):
@@ -384,93 +655,219 @@ class QgisVectorStyle(Resource, QgisStyleMixin):
     def render_request(self, srs, cond=None):
         return RenderRequest(self, srs, cond)
 
-    def _render_image(self, srs, extent, size, *, symbols=None, feature_filter=None, padding=None):
+    def _render_style(self, srs, extent, size):
+        """Parsed style cache entry if something can be rendered at the
+        extent scale"""
+
+        if not self._check_scale_range_cache(extent, size, dpi=96):
+            return None
+
         env.qgis.qgis_init()
 
-        style = read_style(self)
-        if not check_scale_range(style, extent, size, dpi=96):
+        style_entry = read_style_entry(self)
+        if self.qgis_scale_range_cache is None and not check_scale_range(
+            style_entry.style, extent, size, dpi=96
+        ):
             return None
 
-        if padding is not None:
-            extended, render_size, target_box = _render_bounds(extent, size, padding)
-        else:
-            extended, render_size = extent, size
+        return style_entry
+
+    def _query_features(
+        self, srs, extent, pixel_size, *, attributes=None, feature_filter=None, style_filter=None
+    ):
+        """Fetch features intersecting the extent with given attributes
+
+        Attribute names are expected in lower case, all fields are fetched if
+        attributes are None. The style filter only reduces the number of
+        fetched features and is ignored if it can't be applied. Returns QGIS
+        layer fields, feature layer field types and features converted for
+        QGIS."""
 
         feature_layer = self.parent
+        if (
+            feature_filter is None
+            and srs.id == feature_layer.srs.id
+            and (snapshot := _feature_snapshot(feature_layer, attributes)) is not None
+        ):
+            with render_phase("fetch"):
+                features = snapshot.query(extent)
+            count_features(features)
+            return snapshot.qhl_fields, snapshot.typ_fields, features
+
         feature_query = feature_layer.feature_query()
-        if feature_filter is not None and IFilterableFeatureLayer.providedBy(feature_layer):
-            filter_program = feature_layer.filter_parser.parse(feature_filter)
-            feature_query.set_filter_program(filter_program)
+        if IFilterableFeatureLayer.providedBy(feature_layer):
+            with render_phase("filter"):
+                filter_program = _filter_program(feature_layer, feature_filter, style_filter)
+            if filter_program is not None:
+                feature_query.set_filter_program(filter_program)
         feature_query.srs(srs)
 
-        bbox = Geometry.from_shape(box(*extended), srid=srs.id)
+        bbox = Geometry.from_shape(box(*extent), srid=srs.id)
         feature_query.intersects(bbox)
         feature_query.geom()
 
-        crs = CRS.from_epsg(srs.id)
+        simplify = env.qgis.options["simplify.tolerance"]
+        if (
+            simplify
+            and IFeatureQuerySimplify.providedBy(feature_query)
+            and feature_layer.geometry_type not in _POINT_GEOM_TYPES
+        ):
+            # Vertices closer than a fraction of a pixel are indistinguishable
+            feature_query.simplify(pixel_size * simplify)
 
-        mreq = MapRequest()
-        mreq.set_dpi(96)
-        mreq.set_crs(crs)
+        qhl_fields, cnv_fields, qry_fields, typ_fields = _layer_fields(feature_layer, attributes)
+        feature_query.fields(*qry_fields)
 
-        style_attrs = style.used_attributes()
-        if style_attrs is not None:
-            style_attrs = {attr.lower() for attr in style_attrs}
+        # Features are streamed from the query directly into a single tuple
+        # instead of an intermediate list, so only one copy of the geometries
+        # exists on the Python side.
+        with render_phase("fetch"):
+            features = tuple(_feature_feed(feature_query(), _row_converter(cnv_fields)))
+        count_features(features)
 
-        qhl_fields = list()
-        cnv_fields = list()
-        qry_fields = list()
+        return qhl_fields, typ_fields, features
 
-        for field in self.parent.fields:
-            fkeyname = field.keyname
-            if (style_attrs is not None) and (fkeyname.lower() not in style_attrs):
-                continue
-            field_to_qgis = _FIELD_TYPE_TO_QGIS[field.datatype]
-            qhl_fields.append((fkeyname, field_to_qgis[0]))
-            cnv_fields.append((fkeyname, field_to_qgis[1]))
-            qry_fields.append(fkeyname)
+    def _render_image(self, srs, extent, size, *, symbols=None, feature_filter=None, padding=None):
+        return self._render_images(
+            srs,
+            (extent,),
+            size,
+            symbols=symbols,
+            feature_filter=feature_filter,
+            padding=padding,
+        )[0]
+
+    def _render_images(
+        self, srs, extents, size, *, symbols=None, feature_filter=None, padding=None
+    ):
+        """Render images of the same size for multiple extents
+
+        Features for all extents are fetched with a single query and loaded
+        into a single QGIS layer. Extents are expected to have the same scale,
+        like tiles of the same zoom level."""
+
+        result = [None] * len(extents)
+        extent = extents[0]
+        with render_phase("style"):
+            style_entry = self._render_style(srs, extent, size)
+        if style_entry is None:
+            return result
+        style = style_entry.style
+
+        if padding == PADDING_AUTO:
+            padding = _auto_padding(style_entry, extent, size)
 
-        feature_query.fields(*qry_fields)
+        if padding is not None:
+            bounds = [_render_bounds(e, size, padding) for e in extents]
+        else:
+            bounds = [(e, size, None) for e in extents]
+
+        # Union of extended extents for the feature query
+        extended = (
+            min(b[0][0] for b in bounds),
+            min(b[0][1] for b in bounds),
+            max(b[0][2] for b in bounds),
+            max(b[0][3] for b in bounds),
+        )
+        b_extent, render_size, _ = bounds[0]
+        pixel_size = (b_extent[2] - b_extent[0]) / render_size[0]
+
+        style_filter = None
+        if IFilterableFeatureLayer.providedBy(self.parent):
+            with render_phase("filter"):
+                style_filter = _style_filter(style_entry, self.parent, extent, size, symbols)
+            if style_filter == []:
+                # No rules or symbols are visible at this scale
+                return result
+
+        qhl_fields, typ_fields, features = self._query_features(
+            srs,
+            extended,
+            pixel_size,
+            attributes=_style_attributes(style),
+            feature_filter=feature_filter,
+            style_filter=style_filter,
+        )
+        if len(features) == 0:
+            return result
 
-        features = list()
-        for feat in feature_query():
-            features.append(
-                (
-                    feat.id,
-                    feat.geom.wkb,
-                    tuple([convert(feat.fields[field]) for field, convert in cnv_fields]),
-                )
+        if (pool := env.qgis.render_pool) is not None:
+            source = VectorSource(
+                geometry_type=self.parent.geometry_type,
+                fields=typ_fields,
+                features=features,
             )
+            del features
 
-        if len(features) == 0:
-            return None
+            def render(b_extent, b_size, target_box):
+                job = self._render_job(style, srs, source, b_extent, b_size, symbols)
+                with render_phase("render"):
+                    return pool.render(job, target_box)
 
-        layer = Layer.from_data(
-            _GEOM_TYPE_TO_QGIS[self.parent.geometry_type], crs, tuple(qhl_fields), tuple(features)
-        )
+        else:
+            crs = CRS.from_epsg(srs.id)
+
+            mreq = MapRequest()
+            mreq.set_dpi(96)
+            mreq.set_crs(crs)
 
-        idx = mreq.add_layer(layer, style)
+            with render_phase("layer"):
+                layer = Layer.from_data(
+                    _GEOM_TYPE_TO_QGIS[self.parent.geometry_type], crs, qhl_fields, features
+                )
 
-        render_params = dict()
-        if symbols is not None:
-            render_params["symbols"] = ((idx, symbols),)
-        res = mreq.render_image(extended, render_size, **render_params)
-        im = qgis_image_to_pil(res)
+            # QGIS memory provider holds its own copy of the data
+            del features
 
-        if padding is not None:
-            im = im.crop(target_box)
-            assert im.size == tuple(size)
+            idx = mreq.add_layer(layer, style)
 
-        return im
+            render_params = dict()
+            if symbols is not None:
+                render_params["symbols"] = ((idx, symbols),)
+
+            def render(b_extent, b_size, target_box):
+                with render_phase("render"):
+                    res = mreq.render_image(b_extent, b_size, **render_params)
+                with render_phase("image"):
+                    return _render_result_to_pil(res, target_box)
+
+        for i, (b_extent, b_size, target_box) in enumerate(bounds):
+            im = render(b_extent, b_size, target_box)
+            if im is None:
+                continue
+
+            if padding is not None:
+                assert im.size == tuple(size)
+
+                # Features may be visible in the padding area only
+                if im.getbbox() is None:
+                    continue
+
+            result[i] = im
+
+        return result
 
     def render_legend(self):
+        # PNG-compressed buffer is required for ILegendableStyle, so only the
+        # encoded image is cached.
         env.qgis.qgis_init()
+        entry = read_style_entry(self)
+        png = entry.derive(
+            "legend_png",
+            lambda style: _png_bytes(self._render_legend_image(style)),
+            sizeof=len,
+        )
+        return BytesIO(png)
 
+    def render_legend_image(self):
+        """Render legend as PIL Image without PNG encoding round trip"""
+        env.qgis.qgis_init()
+        return self._render_legend_image(read_style_entry(self).style)
+
+    def _render_legend_image(self, style):
         mreq = MapRequest()
         mreq.set_dpi(96)
 
-        style = read_style(self)
-
         layer = Layer.from_data(
             _GEOM_TYPE_TO_QGIS[self.parent.geometry_type],
             CRS.from_epsg(self.parent.srs.id),
@@ -480,23 +877,25 @@ class QgisVectorStyle(Resource, QgisStyleMixin):
 
         mreq.add_layer(layer, style)
         res = mreq.render_legend()
-        img = qgis_image_to_pil(res)
-
-        # PNG-compressed buffer is required for render_legend()
-        # TODO: Switch to PIL Image in future!
-        buf = BytesIO()
-        img.save(buf, "png")
-        buf.seek(0)
-        return buf
+        return qgis_image_to_pil(res)
 
     def legend_symbols(self, icon_size):
         env.qgis.qgis_init()
 
+        key = ("legend_symbols", icon_size)
+        entry = read_style_entry(self)
+        return list(
+            entry.derive(
+                key,
+                lambda style: self._legend_symbols(style, icon_size),
+                sizeof=_legend_symbols_size,
+            )
+        )
+
+    def _legend_symbols(self, style, icon_size):
         mreq = MapRequest()
         mreq.set_dpi(96)
 
-        style = read_style(self)
-
         layer = Layer.from_data(
             _GEOM_TYPE_TO_QGIS[self.parent.geometry_type],
             CRS.from_epsg(self.parent.srs.id),
@@ -547,9 +946,13 @@ class RenderRequest:
                 if "filter" in cond:
                     self.params["feature_filter"] = cond["filter"]
 
+        # Filter is serialized once for all render cache keys
+        feature_filter = self.params.get("feature_filter")
+        self._filter_key = None if feature_filter is None else json_dumps(feature_filter)
+
     def render_extent(self, extent, size):
         try:
-            return self.style._render_image(self.srs, extent, size, **self.params)
+            return self._render(extent, size, self.params)
         except Exception as exc:
             _reraise_qgis_exception(exc, OperationalError)
 
@@ -557,12 +960,271 @@ class RenderRequest:
         extent = self.srs.tile_extent(tile)
         params = dict(self.params)
         if isinstance(self.style, QgisVectorStyle):
-            params["padding"] = 64
+            params["padding"] = PADDING_AUTO
+            metatile = env.qgis.options["metatile.size"]
+            if metatile > 1:
+                return self._render_metatile(tile, size, metatile, params)
+        try:
+            return self._render(extent, (size, size), params)
+        except Exception as exc:
+            _reraise_qgis_exception(exc, OperationalError)
+
+    def render_tiles(self, tiles, size):
+        """Render multiple tiles of the same zoom level
+
+        Vector style tiles are rendered from features fetched with a single
+        query per rectangular block of adjacent tiles, other styles fall back
+        to rendering tiles one by one."""
+
+        if not isinstance(self.style, QgisVectorStyle):
+            return [self.render_tile(tile, size) for tile in tiles]
+
+        if len({z for z, x, y in tiles}) > 1:
+            raise ValueError("Tiles of different zoom levels can't be rendered together.")
+
+        params = dict(self.params, padding=PADDING_AUTO)
+        cache = env.qgis.empty_cache
+        base_key = self._render_key()
+
+        result = [None] * len(tiles)
+        pending = dict()
+        with cache.lock:
+            for i, tile in enumerate(tiles):
+                extent = self.srs.tile_extent(tile)
+                key = base_key + (tuple(extent), (size, size), params["padding"])
+                if key not in cache:
+                    pending[i] = (extent, key)
+
+        if len(pending) == 0:
+            return result
+
+        # Features are fetched for a bounding box of tiles, so only adjacent
+        # tiles forming a rectangle are rendered together.
+        indexes = list(pending)
         try:
-            return self.style._render_image(self.srs, extent, (size, size), **params)
+            with _render_timing(self.style):
+                for block in _tile_blocks([tiles[i] for i in indexes]):
+                    block = [indexes[b] for b in block]
+                    images = self.style._render_images(
+                        self.srs,
+                        [pending[i][0] for i in block],
+                        (size, size),
+                        **params,
+                    )
+                    for i, im in zip(block, images):
+                        result[i] = im
         except Exception as exc:
             _reraise_qgis_exception(exc, OperationalError)
 
+        with cache.lock:
+            for i, (_, key) in pending.items():
+                if result[i] is None:
+                    cache[key] = True
+
+        return result
+
+    def _render_key(self):
+        return (
+            self.style.id,
+            _cache_key(self.style),
+            _data_version(self.style.parent),
+            self.srs.id,
+            self.params.get("symbols"),
+            self._filter_key,
+        )
+
+    def _render(self, extent, size, params):
+        cache = env.qgis.empty_cache
+        key = self._render_key() + (tuple(extent), tuple(size), params.get("padding"))
+
+        with cache.lock:
+            if key in cache:
+                return None
+
+        im = env.qgis.render_flight(key, self._timed_render, self.srs, extent, size, **params)
+        if im is None:
+            with cache.lock:
+                cache[key] = True
+
+        return im
+
+    def _timed_render(self, *args, **kwargs):
+        # Only the caller actually rendering records timing, callers waiting
+        # for its result don't.
+        with _render_timing(self.style):
+            return self.style._render_image(*args, **kwargs)
+
+    def _render_metatile(self, tile, size, metatile, params):
+        z, x, y = tile
+        cache = env.qgis.metatile_cache
+        key = self._render_key() + (z, size)
+
+        with cache.lock:
+            im = cache.pop(key + (x, y), MISSING)
+        if im is not MISSING:
+            return im
+
+        # Metatile origin and dimensions clamped to the tile matrix
+        mx, my = x - x % metatile, y - y % metatile
+        nx = min(metatile, (1 << z) - mx)
+        ny = min(metatile, (1 << z) - my)
+
+        tiles = [(tx, ty) for ty in range(my, my + ny) for tx in range(mx, mx + nx)]
+        extents = {t: self.srs.tile_extent((z, *t)) for t in tiles}
+        extent = (
+            min(e[0] for e in extents.values()),
+            min(e[1] for e in extents.values()),
+            max(e[2] for e in extents.values()),
+            max(e[3] for e in extents.values()),
+        )
+        msize = (nx * size, ny * size)
+
+        try:
+            mim = self._render(extent, msize, params)
+        except Exception as exc:
+            _reraise_qgis_exception(exc, OperationalError)
+
+        res_x = (extent[2] - extent[0]) / msize[0]
+        res_y = (extent[3] - extent[1]) / msize[1]
+
+        result = None
+        with cache.lock:
+            for t, te in extents.items():
+                if mim is None:
+                    tim = None
+                else:
+                    left = round((te[0] - extent[0]) / res_x)
+                    top = round((extent[3] - te[3]) / res_y)
+                    tim = mim.crop((left, top, left + size, top + size))
+                    if tim.getbbox() is None:
+                        # Features may be visible in other tiles only
+                        tim = None
+                if t == (x, y):
+                    result = tim
+                else:
+                    cache[key + t] = tim
+
+        return result
+
+
+class _SharedFetch:
+    """Features fetched once for multiple styles of the same feature layer"""
+
+    def __init__(self, qgis_style, feature_filter):
+        self.qgis_style = qgis_style
+        self.feature_filter = feature_filter
+        self.attributes = set()
+        self.result = None
+
+    def add(self, style):
+        attrs = _style_attributes(style)
+        if attrs is None or self.attributes is None:
+            self.attributes = None
+        else:
+            self.attributes |= attrs
+
+    def __call__(self, srs, extent, size):
+        if self.result is None:
+            pixel_size = (extent[2] - extent[0]) / size[0]
+            qhl_fields, _, features = self.qgis_style._query_features(
+                srs,
+                extent,
+                pixel_size,
+                attributes=self.attributes,
+                feature_filter=self.feature_filter,
+            )
+            self.result = (qhl_fields, features)
+        return self.result
+
+
+@contextmanager
+def _render_timing(qgis_style):
+    with render_timing() as timing:
+        yield
+
+    env.qgis.render_stats.record(qgis_style.id, timing)
+    if env.qgis.options["timing.server_timing"]:
+        add_server_timing(timing)
+
+
+def render_composite(requests, extent, size):
+    """Render QGIS style render requests into a single image
+
+    Requests are drawn in the given order, so the last one is on top. Styles
+    are rendered with a single QGIS map request, so labels of different
+    styles don't overlap each other. Vector styles of the same feature layer
+    and filter share features fetched with a single query. Returns None if
+    nothing is rendered."""
+
+    srs = requests[0].srs
+    if any(req.srs.id != srs.id for req in requests):
+        raise ValueError("Render requests must have the same SRS.")
+
+    try:
+        # Styles which can be rendered at the extent scale
+        pending = list()
+        fetches = dict()
+        for req in reversed(requests):
+            qgis_style = req.style
+            params = req.params
+            if isinstance(qgis_style, QgisVectorStyle):
+                if (style_entry := qgis_style._render_style(srs, extent, size)) is None:
+                    continue
+                style = style_entry.style
+
+                feature_filter = params.get("feature_filter")
+                key = (
+                    qgis_style.parent.id,
+                    None if feature_filter is None else json_dumps(feature_filter),
+                )
+                if (fetch := fetches.get(key)) is None:
+                    fetch = fetches[key] = _SharedFetch(qgis_style, feature_filter)
+                fetch.add(style)
+            else:
+                if (style := qgis_style._render_style(srs, extent, size)) is None:
+                    continue
+                fetch = None
+            pending.append((qgis_style, style, fetch, params.get("symbols")))
+
+        crs = CRS.from_epsg(srs.id)
+
+        mreq = MapRequest()
+        mreq.set_dpi(96)
+        mreq.set_crs(crs)
+
+        layers = 0
+        render_symbols = list()
+
+        # Borrowed raster layers are returned after the render
+        with ExitStack() as stack:
+            # QGIS draws the first added layer on top of others
+            for qgis_style, style, fetch, symbols in pending:
+                if fetch is None:
+                    layer = stack.enter_context(qgis_style._qgis_layer())
+                else:
+                    qhl_fields, features = fetch(srs, extent, size)
+                    if len(features) == 0:
+                        continue
+                    geom_type = _GEOM_TYPE_TO_QGIS[qgis_style.parent.geometry_type]
+                    layer = Layer.from_data(geom_type, crs, qhl_fields, features)
+
+                idx = mreq.add_layer(layer, style)
+                layers += 1
+                if symbols is not None:
+                    render_symbols.append((idx, symbols))
+
+            if layers == 0:
+                return None
+
+            render_params = dict()
+            if len(render_symbols) > 0:
+                render_params["symbols"] = tuple(render_symbols)
+            res = mreq.render_image(extent, size, **render_params)
+
+        return _render_result_to_pil(res)
+    except Exception as exc:
+        _reraise_qgis_exception(exc, OperationalError)
+
 
 class FormatAttr(SAttribute):
     def get(self, srlzr: Serializer) -> QgisStyleFormat:
@@ -645,7 +1307,13 @@ class CopyFromAttr(SAttribute):
         if not style.has_permission(ResourceScope.read, srlzr.user):
             raise InsufficientPermissions()  # TODO: Add more details
 
-        for attr in ("qgis_format", "qgis_fileobj", "qgis_sld", "svg_marker_library"):
+        for attr in (
+            "qgis_format",
+            "qgis_fileobj",
+            "qgis_sld",
+            "qgis_content_hash",
+            "svg_marker_library",
+        ):
             if hasattr(style, attr):
                 setattr(srlzr.obj, attr, getattr(style, attr))
 
@@ -675,23 +1343,62 @@ class QgisRasterStyleSerializer(Serializer, resource=QgisRasterStyle):
     copy_from = CopyFromAttr(read=None, write=ResourceScope.update)
 
 
-_style_cache = LRUCache(maxsize=256)
+class QgisDataVersion(Base):
+    """Version of layer data bumped on each data change
+
+    Versions are persisted, so caches keyed by them in any process see data
+    changes made by other processes as soon as they're committed."""
+
+    __tablename__ = "qgis_data_version"
+
+    resource_id: Mapped[int] = mapped_column(
+        sa.ForeignKey(Resource.id, ondelete="CASCADE"),
+        primary_key=True,
+    )
+    version: Mapped[int]
+
+
+@on_data_change.connect
+def _on_data_change(resource, *args, **kwargs):
+    stmt = pg_insert(QgisDataVersion).values(resource_id=resource.id, version=1)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[QgisDataVersion.resource_id],
+        set_=dict(version=QgisDataVersion.version + 1),
+    )
+    DBSession.execute(stmt)
+
+
+def _data_version(layer):
+    version = DBSession.execute(
+        sa.select(QgisDataVersion.version).where(QgisDataVersion.resource_id == layer.id)
+    ).scalar()
+    return 0 if version is None else version
 
 
 def _cache_key(qgis_style):
     if qgis_style.qgis_format == QgisStyleFormat.DEFAULT:
         return qgis_style.id
 
-    if qgis_style.qgis_format == QgisStyleFormat.SLD:
-        uuid = UUID(int=qgis_style.qgis_sld_id, version=4).hex
+    if (content_hash := qgis_style.qgis_content_hash) is not None:
+        # Styles with identical sources share the same key
+        source = (qgis_style.qgis_format.value, content_hash)
+    elif qgis_style.qgis_format == QgisStyleFormat.SLD:
+        source = UUID(int=qgis_style.qgis_sld_id, version=4).hex
     else:
-        uuid = UUID(int=2**127 + qgis_style.qgis_fileobj_id, version=4).hex
+        source = UUID(int=2**127 + qgis_style.qgis_fileobj_id, version=4).hex
 
     if isinstance(qgis_style, QgisRasterStyle):
-        return uuid
+        return source
 
+    # SVG paths are resolved against the library, so styles with identical
+    # sources and different libraries have different keys
     sml = qgis_style.svg_marker_library
-    return (uuid, None if sml is None else sml.tstamp, qgis_style.parent.geometry_type)
+    return (
+        source,
+        qgis_style.svg_marker_library_id,
+        None if sml is None else sml.tstamp,
+        qgis_style.parent.geometry_type,
+    )
 
 
 def _read_style(qgis_style):
@@ -741,11 +1448,30 @@ def _read_style(qgis_style):
     return Style.from_file(filename, **params)
 
 
+def _style_size(qgis_style):
+    # Parsed style size is estimated by its source size
+    if qgis_style.qgis_format == QgisStyleFormat.DEFAULT:
+        return STYLE_SIZE_OVERHEAD
+    elif qgis_style.qgis_format == QgisStyleFormat.SLD:
+        return STYLE_SIZE_OVERHEAD + len(qgis_style.qgis_sld.to_xml())
+    filename = env.file_storage.filename(qgis_style.qgis_fileobj)
+    return STYLE_SIZE_OVERHEAD + getsize(filename)
+
+
+def read_style_entry(qgis_style):
+    return env.qgis.style_cache.get(
+        _cache_key(qgis_style),
+        lambda: (_read_style(qgis_style), _style_size(qgis_style)),
+    )
+
+
 def read_style(qgis_style):
-    key = _cache_key(qgis_style)
-    if (style := _style_cache.get(key)) is None:
-        style = _style_cache[key] = _read_style(qgis_style)
-    return style
+    return read_style_entry(qgis_style).style
+
+
+def _update_content_hash_event(mapper, connection, qgis_style):
+    if qgis_style.qgis_content_hash is None and qgis_style.qgis_format != QgisStyleFormat.DEFAULT:
+        qgis_style._update_content_hash()
 
 
 def _update_scale_range_cache_event(mapper, connection, qgis_style):
@@ -757,9 +1483,16 @@ def _update_scale_range_cache_event(mapper, connection, qgis_style):
             return
 
 
+def _reset_content_hash_event(qgis_style, value, oldvalue, initiator):
+    qgis_style.qgis_content_hash = None
+
+
 for cls in (QgisRasterStyle, QgisVectorStyle):
     for event in ("before_insert", "before_update"):
+        sa.event.listens_for(cls, event)(_update_content_hash_event)
         sa.event.listens_for(cls, event)(_update_scale_range_cache_event)
+    for attr in ("qgis_format", "qgis_fileobj", "qgis_sld"):
+        sa.event.listens_for(getattr(cls, attr), "set")(_reset_content_hash_event)
 
 
 def check_scale_range(style, extent, size, *, dpi):
@@ -767,10 +1500,257 @@ def check_scale_range(style, extent, size, *, dpi):
     if min_denom is None and max_denom is None:
         return True
 
-    denom = (extent[2] - extent[0]) * dpi / (size[0] * 0.0254)
+    denom = _scale_denom(extent, size, dpi=dpi)
     return (min_denom is None or min_denom > denom) and (max_denom is None or max_denom < denom)
 
 
+def _scale_denom(extent, size, *, dpi):
+    return (extent[2] - extent[0]) * dpi / (size[0] * 0.0254)
+
+
+def _style_filter(style_entry, feature_layer, extent, size, symbols=None):
+    """Feature filter matching features which can be drawn by the style at
+    the extent scale with given symbols, None if any feature may be drawn or
+    an empty list if no features are drawn at all"""
+
+    # Rules and symbol filters are extracted once per parsed style
+    parts = list()
+    rules = style_entry.derive("rule_filter", lambda style: rule_filter(style.to_string()))
+    if rules is not None:
+        parts.append(rules.filter(_scale_denom(extent, size, dpi=96)))
+    if symbols is not None:
+        symbol_filters = style_entry.derive(
+            "symbol_filter",
+            lambda style: symbol_filter(style.to_string()),
+        )
+        if symbol_filters is not None:
+            parts.append(symbol_filters.filter(symbols))
+
+    fields = {field.keyname.lower(): field for field in feature_layer.fields}
+
+    result = list()
+    for items in parts:
+        if items is None:
+            continue
+        if len(items) == 0:
+            return []
+        try:
+            items = [_resolve_filter(item, fields) for item in items]
+        except ExpressionError:
+            continue
+        result.append(items[0] if len(items) == 1 else ["any", *items])
+
+    if len(result) == 0:
+        return None
+    return result[0] if len(result) == 1 else ["all", *result]
+
+
+_FILTER_NUMERIC_TYPES = (FIELD_TYPE.INTEGER, FIELD_TYPE.BIGINT, FIELD_TYPE.REAL)
+
+# Database collations order strings differently from QGIS
+_FILTER_ORDERING_OPS = ("<", "<=", ">", ">=")
+
+
+def _resolve_literal(value, field):
+    if field.datatype in _FILTER_NUMERIC_TYPES:
+        if isinstance(value, str):
+            # Category values are strings in QML
+            for convert in (int, float):
+                try:
+                    return convert(value)
+                except ValueError:
+                    pass
+        elif isinstance(value, (int, float)):
+            return value
+    elif field.datatype == FIELD_TYPE.STRING and isinstance(value, str):
+        return value
+    raise ExpressionError(f"Value type doesn't match field '{field.keyname}'")
+
+
+def _resolve_filter(expr, fields):
+    """Replace field names in a style filter with layer field keynames
+
+    ExpressionError is raised for missing fields and for literals which can't
+    be converted to field types, QGIS converts types implicitly but SQL
+    doesn't. Only numeric fields can be compared with ordering operators."""
+
+    op, *args = expr
+    if op in ("all", "any"):
+        return [op, *(_resolve_filter(arg, fields) for arg in args)]
+
+    (_, name), value = args
+    if (field := fields.get(name.lower())) is None:
+        raise ExpressionError(f"Field '{name}' not found")
+    if op in _FILTER_ORDERING_OPS and field.datatype not in _FILTER_NUMERIC_TYPES:
+        raise ExpressionError(f"Field '{field.keyname}' can't be compared in SQL")
+    return [op, ["get", field.keyname], _resolve_literal(value, field)]
+
+
+def _filter_program(feature_layer, feature_filter, style_filter):
+    if style_filter is not None:
+        combined = style_filter
+        if feature_filter is not None:
+            combined = ["all", feature_filter, style_filter]
+        # Style filters are optional, fall back to the render filter
+        filter_program = _parse_filter(feature_layer, combined, optional=True)
+        if filter_program is not None:
+            return filter_program
+
+    if feature_filter is not None:
+        return _parse_filter(feature_layer, feature_filter)
+
+    return None
+
+
+def _parse_filter(feature_layer, feature_filter, *, optional=False):
+    """Parse a feature filter with caching
+
+    Optional filters which can't be parsed give None, and the failure is
+    cached too, so they aren't parsed on every render."""
+
+    # Parsed programs depend on layer fields, so they are a part of the key
+    key = (feature_layer.id, _fields_signature(feature_layer), json_dumps(feature_filter))
+
+    cache = env.qgis.filter_cache
+    with cache.lock:
+        filter_program = cache.get(key, MISSING)
+    if filter_program is not MISSING and (filter_program is not None or optional):
+        return filter_program
+
+    try:
+        filter_program = feature_layer.filter_parser.parse(feature_filter)
+    except ValidationError:
+        if not optional:
+            raise
+        filter_program = None
+
+    with cache.lock:
+        cache[key] = filter_program
+    return filter_program
+
+
+def _style_attributes(style):
+    """Lower-cased names of attributes used by the style or None if the
+    style may use any attribute"""
+
+    attrs = style.used_attributes()
+    if attrs is None:
+        return None
+    return {attr.lower() for attr in attrs}
+
+
+def _layer_fields(feature_layer, attributes=None):
+    """Field lists for QGIS layer, converters, query and field types"""
+
+    qhl_fields = list()
+    cnv_fields = list()
+    qry_fields = list()
+    typ_fields = list()
+
+    for field in feature_layer.fields:
+        fkeyname = field.keyname
+        if (attributes is not None) and (fkeyname.lower() not in attributes):
+            continue
+        field_to_qgis = _FIELD_TYPE_TO_QGIS[field.datatype]
+        qhl_fields.append((fkeyname, field_to_qgis[0]))
+        cnv_fields.append((fkeyname, field_to_qgis[1]))
+        qry_fields.append(fkeyname)
+        typ_fields.append((fkeyname, field.datatype))
+
+    return tuple(qhl_fields), tuple(cnv_fields), tuple(qry_fields), tuple(typ_fields)
+
+
+def _fields_signature(feature_layer):
+    return tuple((field.keyname, field.datatype) for field in feature_layer.fields)
+
+
+def _feature_snapshot(feature_layer, attributes):
+    if (cache := env.qgis.snapshot_cache) is None:
+        return None
+
+    # Data versions are persisted, so data changes made by other processes
+    # invalidate snapshots too
+    key = (
+        feature_layer.id,
+        _data_version(feature_layer),
+        _fields_signature(feature_layer),
+        None if attributes is None else tuple(sorted(attributes)),
+    )
+    return cache.get(key, lambda limit: _snapshot_features(feature_layer, attributes, limit))
+
+
+def _snapshot_features(feature_layer, attributes, limit):
+    qhl_fields, cnv_fields, qry_fields, typ_fields = _layer_fields(feature_layer, attributes)
+
+    feature_query = feature_layer.feature_query()
+    feature_query.geom()
+    feature_query.fields(*qry_fields)
+    feature_query.limit(limit + 1)
+
+    features = tuple(_feature_feed(feature_query(), _row_converter(cnv_fields)))
+    if len(features) > limit:
+        return None
+
+    return qhl_fields, typ_fields, features
+
+
+def _row_converter(cnv_fields):
+    """Compile a converter of feature field batches into QGIS attribute rows
+
+    Values of all fields are fetched in one pass, and only fields with
+    non-identity converters are converted column by column."""
+
+    getter = itemgetter(*(field for field, _ in cnv_fields)) if cnv_fields else None
+    columns = tuple(
+        (idx, convert)
+        for idx, (_, convert) in enumerate(cnv_fields)
+        if convert is not _convert_none
+    )
+
+    def convert_batch(batch):
+        if getter is None:
+            return [()] * len(batch)
+        elif len(cnv_fields) == 1:
+            rows = [(getter(fields),) for fields in batch]
+        else:
+            rows = [getter(fields) for fields in batch]
+
+        if len(columns) == 0:
+            return rows
+
+        transposed = list(zip(*rows))
+        for idx, convert in columns:
+            transposed[idx] = map(convert, transposed[idx])
+        return list(zip(*transposed))
+
+    return convert_batch
+
+
+def _feature_feed(query_result, row_converter):
+    for batch in batched(query_result, _FEATURE_BATCH_SIZE):
+        rows = row_converter([feat.fields for feat in batch])
+        for feat, row in zip(batch, rows):
+            yield (feat.id, feat.geom.wkb, row)
+
+
+def _render_result_to_pil(res, box=None):
+    data = res.to_bytes()
+    if bgra_transparent(data):
+        return None
+    return bgra_to_pil(data, res.size(), box)
+
+
+def _legend_symbols_size(symbols):
+    # Icons take the most memory
+    return sum(s.icon.width * s.icon.height * 4 + LEGEND_SYMBOL_SIZE_OVERHEAD for s in symbols)
+
+
+def _png_bytes(img):
+    buf = BytesIO()
+    img.save(buf, "png")
+    return buf.getvalue()
+
+
 def _convert_none(v):
     return v
 
@@ -0,0 +1,411 @@
+import os
+import pickle
+import subprocess
+import sys
+from fcntl import LOCK_EX, flock
+from multiprocessing import get_context, resource_tracker
+from multiprocessing.connection import Client, Listener
+from multiprocessing.shared_memory import SharedMemory
+from queue import Empty, Queue
+from threading import Lock, Thread
+from time import monotonic, sleep
+from typing import Any, Union
+
+from cachetools import LRUCache
+from msgspec import Struct
+
+import qgis_headless as qh
+
+from .util import bgra_to_pil, bgra_transparent
+
+# Time to wait for the server start and for a reply after the render timeout
+SERVER_START_TIMEOUT = 30
+SERVER_REPLY_GRACE = 5
+
+# Time a job may wait for an idle render process
+QUEUE_TIMEOUT = 300
+
+# Idle time after which the server stops, so servers with outdated code or
+# settings don't stay forever
+SERVER_IDLE_TIMEOUT = 3600
+
+
+class VectorSource(Struct, kw_only=True):
+    geometry_type: str
+    fields: tuple[tuple[str, str], ...]
+    features: tuple[Any, ...]
+
+
+class RasterSource(Struct, kw_only=True):
+    path: str
+
+
+class RenderJob(Struct, kw_only=True):
+    srid: int
+    style_key: Any
+    style_xml: str
+    source: Union[VectorSource, RasterSource]
+    extent: tuple[float, float, float, float]
+    size: tuple[int, int]
+    symbols: Union[tuple[int, ...], None] = None
+
+
+class RenderPool:
+    """Client of a render server shared by all processes of the host
+
+    The server runs a pool of dedicated processes rendering with QGIS
+    headless, so the number of render processes doesn't depend on the number
+    of WSGI workers. It's started on the first render if it isn't running
+    yet and listens on a Unix socket. Jobs and rendered images are passed
+    through shared memory buffers, and fully transparent images are returned
+    as None."""
+
+    def __init__(self, address, *, size, timeout, executable, logging_level, svg_path):
+        self.address = address
+        self.size = size
+        self.timeout = timeout
+        self.executable = executable
+        self.logging_level = logging_level
+        self.svg_path = svg_path
+
+    def render(self, job, box=None):
+        payload = pickle.dumps(job, protocol=pickle.HIGHEST_PROTOCOL)
+        payload_size = len(payload)
+
+        # The same buffer is used for the job and the rendered image
+        width, height = job.size
+        shm = SharedMemory(create=True, size=max(payload_size, width * height * 4))
+        try:
+            shm.buf[:payload_size] = payload
+            del payload
+
+            self._request(("render", shm.name, payload_size, self.timeout))
+
+            data = shm.buf[: width * height * 4]
+            try:
+                if bgra_transparent(data):
+                    return None
+                return bgra_to_pil(data, job.size, box)
+            finally:
+                data.release()
+        finally:
+            shm.close()
+            shm.unlink()
+
+    def shutdown(self):
+        """Stop the render server if it's running"""
+        try:
+            conn = Client(self.address, family="AF_UNIX")
+        except (FileNotFoundError, ConnectionRefusedError):
+            return
+        with conn:
+            conn.send(("shutdown",))
+
+    def _request(self, message):
+        try:
+            conn = Client(self.address, family="AF_UNIX")
+        except (FileNotFoundError, ConnectionRefusedError):
+            self._start_server()
+            conn = Client(self.address, family="AF_UNIX")
+
+        with conn:
+            conn.send(message)
+            # The server replies with an error on timeout, so only wait a bit
+            # longer in case the server itself is stuck. Renders are started
+            # when a render process is available.
+            if not conn.poll(QUEUE_TIMEOUT + SERVER_REPLY_GRACE):
+                raise TimeoutError("Render server didn't reply in time.")
+            status, value = conn.recv()
+            if status == "started":
+                if not conn.poll(self.timeout + SERVER_REPLY_GRACE):
+                    raise TimeoutError("Render server didn't reply in time.")
+                status, value = conn.recv()
+
+        if status == "error":
+            raise value
+        return value
+
+    def _start_server(self):
+        # Processes starting the server at the same time are serialized with
+        # a lock file, and only the first one actually starts it.
+        with open(self.address + ".lock", "w") as lock:
+            flock(lock, LOCK_EX)
+            if self._server_alive():
+                return
+
+            # Socket of a crashed server
+            if os.path.exists(self.address):
+                os.unlink(self.address)
+
+            subprocess.Popen(
+                [
+                    self.executable or sys.executable,
+                    "-m",
+                    __name__,
+                    self.address,
+                    str(self.size),
+                    self.logging_level,
+                    *(self.svg_path or ()),
+                ],
+                stdin=subprocess.DEVNULL,
+                stdout=subprocess.DEVNULL,
+                start_new_session=True,
+            )
+
+            deadline = monotonic() + SERVER_START_TIMEOUT
+            while not self._server_alive():
+                if monotonic() > deadline:
+                    raise RuntimeError("Render server didn't start in time.")
+                sleep(0.05)
+
+    def _server_alive(self):
+        try:
+            conn = Client(self.address, family="AF_UNIX")
+        except (FileNotFoundError, ConnectionRefusedError):
+            return False
+        with conn:
+            conn.send(("ping",))
+            return conn.poll(SERVER_REPLY_GRACE)
+
+
+class RenderServer:
+    """Render server running a pool of render processes
+
+    Each job is sent to an idle render process, and the render timeout starts
+    when the process gets the job, so time spent waiting for an idle process
+    doesn't count. A process which doesn't finish a job in time is terminated
+    and replaced with a new one, other processes aren't affected."""
+
+    def __init__(self, address, size, logging_level, svg_path):
+        self.address = address
+        self.size = size
+        self.initargs = (logging_level, svg_path)
+
+        self._context = get_context("spawn")
+        self._idle = Queue()
+        self._lock = Lock()
+        self._workers = set()
+        self._running = False
+        self._active = None
+
+    def serve(self):
+        for i in range(self.size):
+            self._idle.put(self._spawn())
+
+        self._running = True
+        self._active = monotonic()
+        Thread(target=self._watch_idle, daemon=True).start()
+
+        with Listener(self.address, family="AF_UNIX") as listener:
+            while True:
+                conn = listener.accept()
+                if not self._running:
+                    conn.close()
+                    break
+                Thread(target=self._handle, args=(conn,), daemon=True).start()
+
+        with self._lock:
+            for worker in self._workers:
+                worker.terminate()
+
+    def _stop(self):
+        # Wake up the listener waiting for a connection
+        self._running = False
+        Client(self.address, family="AF_UNIX").close()
+
+    def _watch_idle(self):
+        while self._running:
+            sleep(60)
+            idle = self._idle.qsize() == self.size
+            if idle and monotonic() - self._active > SERVER_IDLE_TIMEOUT:
+                self._stop()
+
+    def _spawn(self):
+        # QGIS and Qt don't survive forking, so use spawn
+        conn, child_conn = self._context.Pipe()
+        process = self._context.Process(
+            target=_worker_main,
+            args=(child_conn, *self.initargs),
+            daemon=True,
+        )
+        process.start()
+        child_conn.close()
+
+        worker = _Worker(process, conn)
+        with self._lock:
+            self._workers.add(worker)
+        return worker
+
+    def _replace(self, worker):
+        worker.terminate()
+        with self._lock:
+            self._workers.discard(worker)
+        return self._spawn()
+
+    def _handle(self, conn):
+        with conn:
+            # Clients send a message right after connecting
+            if not conn.poll(SERVER_REPLY_GRACE):
+                return
+
+            command, *args = conn.recv()
+            self._active = monotonic()
+            if command == "shutdown":
+                self._stop()
+                return
+            elif command == "ping":
+                conn.send(("ok", None))
+                return
+
+            reply = self._render(conn, *args)
+            if reply is None:
+                return
+            try:
+                conn.send(reply)
+            except (pickle.PicklingError, TypeError, AttributeError):
+                conn.send(("error", RuntimeError(repr(reply[1]))))
+
+    def _render(self, conn, shm_name, payload_size, timeout):
+        try:
+            worker = self._idle.get(timeout=QUEUE_TIMEOUT)
+        except Empty:
+            return ("error", TimeoutError("No render process available in time."))
+
+        try:
+            conn.send(("started", None))
+        except OSError:
+            # The client has gone away while waiting
+            self._idle.put(worker)
+            return None
+
+        try:
+            worker.conn.send((shm_name, payload_size))
+            if not worker.conn.poll(timeout):
+                worker = self._replace(worker)
+                return ("error", TimeoutError("Render didn't finish in time."))
+            return worker.conn.recv()
+        except (EOFError, OSError):
+            # The render process crashed
+            worker = self._replace(worker)
+            return ("error", RuntimeError("Render process crashed."))
+        finally:
+            self._idle.put(worker)
+
+
+class _Worker:
+    __slots__ = ("process", "conn")
+
+    def __init__(self, process, conn):
+        self.process = process
+        self.conn = conn
+
+    def terminate(self):
+        self.process.terminate()
+        self.conn.close()
+
+
+_worker_styles = None
+_worker_rasters = None
+
+
+def _worker_init(logging_level, svg_path):
+    global _worker_styles, _worker_rasters
+
+    qh.set_logging_level(getattr(qh.LogLevel, logging_level))
+    qh.init([])
+    if svg_path is not None:
+        qh.set_svg_paths(svg_path)
+
+    _worker_styles = LRUCache(maxsize=64)
+
+    # Render processes handle a single job at a time, so raster layers are
+    # used exclusively. Paths change with the raster data.
+    _worker_rasters = LRUCache(maxsize=16)
+
+
+def _worker_style(job):
+    from .model import _GEOM_TYPE_TO_QGIS
+
+    if (style := _worker_styles.get(job.style_key)) is None:
+        params = dict(format=qh.StyleFormat.QML)
+        if isinstance(job.source, VectorSource):
+            params["layer_type"] = qh.LT_VECTOR
+            params["layer_geometry_type"] = _GEOM_TYPE_TO_QGIS[job.source.geometry_type]
+        else:
+            params["layer_type"] = qh.LT_RASTER
+        style = _worker_styles[job.style_key] = qh.Style.from_string(job.style_xml, **params)
+    return style
+
+
+def _worker_layer(job, crs):
+    from .model import _FIELD_TYPE_TO_QGIS, _GEOM_TYPE_TO_QGIS
+
+    source = job.source
+    if isinstance(source, RasterSource):
+        if (layer := _worker_rasters.get(source.path)) is None:
+            layer = _worker_rasters[source.path] = qh.Layer.from_gdal(source.path)
+        return layer
+
+    return qh.Layer.from_data(
+        _GEOM_TYPE_TO_QGIS[source.geometry_type],
+        crs,
+        tuple((keyname, _FIELD_TYPE_TO_QGIS[datatype][0]) for keyname, datatype in source.fields),
+        source.features,
+    )
+
+
+def _worker_main(conn, logging_level, svg_path):
+    _worker_init(logging_level, svg_path)
+    while True:
+        try:
+            shm_name, payload_size = conn.recv()
+        except EOFError:
+            break
+
+        try:
+            _worker_render(shm_name, payload_size)
+            reply = ("ok", None)
+        except Exception as exc:
+            reply = ("error", exc)
+
+        try:
+            conn.send(reply)
+        except (pickle.PicklingError, TypeError, AttributeError):
+            conn.send(("error", RuntimeError(repr(reply[1]))))
+
+
+def _worker_render(shm_name, payload_size):
+    shm = SharedMemory(shm_name)
+    try:
+        # The buffer is owned and unlinked by the requesting process
+        resource_tracker.unregister(shm._name, "shared_memory")
+
+        with shm.buf[:payload_size] as payload:
+            job = pickle.loads(payload)
+
+        crs = qh.CRS.from_epsg(job.srid)
+
+        mreq = qh.MapRequest()
+        mreq.set_dpi(96)
+        mreq.set_crs(crs)
+
+        idx = mreq.add_layer(_worker_layer(job, crs), _worker_style(job))
+
+        render_params = dict()
+        if job.symbols is not None:
+            render_params["symbols"] = ((idx, job.symbols),)
+        res = mreq.render_image(job.extent, job.size, **render_params)
+
+        data = res.to_bytes()
+        shm.buf[: len(data)] = data
+    finally:
+        shm.close()
+
+
+if __name__ == "__main__":
+    # Import from the package, so render processes unpickle functions and
+    # jobs from the same module as clients use
+    from nextgisweb_qgis.pool import RenderServer
+
+    address, size, logging_level, *svg_path = sys.argv[1:]
+    RenderServer(address, int(size), logging_level, svg_path or None).serve()
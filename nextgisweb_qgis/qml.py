@@ -0,0 +1,542 @@
+import re
+from math import hypot, sqrt
+
+from lxml import etree
+
+# Pixels per unit at 96 DPI, map units depend on the render scale
+_UNIT_PIXELS = {
+    "MM": 96 / 25.4,
+    "Point": 96 / 72,
+    "Pixel": 1,
+    "Inch": 96,
+}
+_MAP_UNITS = ("MapUnit", "RenderMetersInMapUnits")
+
+# Symbol layer properties for marker dimensions, which extend symbols by
+# half of the diagonal if centered and by the full diagonal otherwise
+_DIMENSION_PROPS = {
+    "size": "size_unit",
+    "width": "size_unit",
+    "height": "size_unit",
+    "symbol_width": "symbol_width_unit",
+    "symbol_height": "symbol_height_unit",
+    "hash_length": "hash_length_unit",
+}
+
+# Symbol layer properties for strokes, which may extend symbols by their full
+# width on sharp joins
+_STROKE_PROPS = {
+    "line_width": "line_width_unit",
+    "outline_width": "outline_width_unit",
+    "stroke_width": "stroke_width_unit",
+}
+
+# Symbol layer classes with extents defined by the properties above
+_KNOWN_CLASSES = {
+    "SimpleMarker",
+    "SvgMarker",
+    "RasterMarker",
+    "FontMarker",
+    "EllipseMarker",
+    "FilledMarker",
+    "SimpleLine",
+    "MarkerLine",
+    "HashLine",
+    "SimpleFill",
+    "GradientFill",
+    "ShapeburstFill",
+    "LinePatternFill",
+    "PointPatternFill",
+    "RasterFill",
+    "SVGFill",
+    "CentroidFill",
+    "RandomMarkerFill",
+}
+
+# Renderers drawing features with symbols only, other renderers like heatmap
+# or point displacement draw beyond symbol extents
+_KNOWN_RENDERERS = {
+    "singleSymbol",
+    "categorizedSymbol",
+    "graduatedSymbol",
+    "RuleRenderer",
+}
+
+_ANCHOR_PROPS = ("horizontal_anchor_point", "vertical_anchor_point")
+
+# Data-defined properties which make symbol extents unpredictable
+_SIZE_DD_PROPS = {
+    "size",
+    "width",
+    "height",
+    "strokeWidth",
+    "outlineWidth",
+    "offset",
+    "horizontalAnchor",
+    "verticalAnchor",
+}
+
+
+class SymbolExtent:
+    """Maximum distance symbols are drawn beyond feature geometries
+
+    Each symbol layer is a list of (value, unit) terms, which are summed to
+    get the symbol layer extent. Extent is unknown if some symbol sizes are
+    data-defined, units or symbol layer classes aren't supported."""
+
+    def __init__(self, layers, *, known, labels):
+        self.layers = layers
+        self.known = known
+        self.labels = labels
+
+    def pixels(self, map_unit_size):
+        """Extent in pixels for the given map units per pixel or None if
+        the extent is unknown"""
+
+        if not self.known:
+            return None
+
+        result = 0
+        for terms in self.layers:
+            value = 0
+            for term, unit in terms:
+                if unit in _MAP_UNITS:
+                    value += term / map_unit_size
+                else:
+                    value += term * _UNIT_PIXELS[unit]
+            result = max(result, value)
+        return result
+
+
+def _layer_props(layer):
+    result = dict()
+    for opt in layer.iterfind("./Option[@type='Map']/Option"):
+        result[opt.get("name")] = opt.get("value")
+    for prop in layer.iterfind("./prop"):
+        result[prop.get("k")] = prop.get("v")
+    return result
+
+
+def _layer_dd_active(layer):
+    result = set()
+    path = "./data_defined_properties/Option/Option[@name='properties']/Option"
+    for prop in layer.iterfind(path):
+        if prop.find("./Option[@name='active'][@value='true']") is not None:
+            result.add(prop.get("name"))
+    return result
+
+
+def _float(value):
+    try:
+        return abs(float(value))
+    except (TypeError, ValueError):
+        return 0
+
+
+def _labels_enabled(root):
+    return root.get("labelsEnabled") == "1" and root.find("./labeling") is not None
+
+
+def _diagrams_enabled(root):
+    return any(
+        el.tag.endswith("DiagramRenderer") and el.get("diagramType") is not None
+        for el in root.iterfind("./*")
+    )
+
+
+def symbol_extent(qml):
+    """Extract symbol extents from QML style string"""
+
+    root = etree.fromstring(qml.encode("utf-8"))
+
+    renderer = root.find("./renderer-v2")
+    known = renderer is not None and renderer.get("type") in _KNOWN_RENDERERS
+
+    layers = dict()
+    for layer in root.iterfind(".//renderer-v2//symbol/layer"):
+        if layer.get("enabled", "1") == "0":
+            continue
+
+        cls = layer.get("class")
+        if cls not in _KNOWN_CLASSES or _layer_dd_active(layer) & _SIZE_DD_PROPS:
+            known = False
+
+        props = _layer_props(layer)
+        terms = list()
+
+        # Markers may be rotated, so the diagonal is used for dimensions, and
+        # the sum of dimensions isn't less than the diagonal.
+        centered = all(props.get(a, "1") == "1" for a in _ANCHOR_PROPS)
+        factor = sqrt(2) / (2 if centered else 1)
+        for name, unit_name in _DIMENSION_PROPS.items():
+            if (value := _float(props.get(name))) > 0:
+                terms.append((value * factor, props.get(unit_name, "MM")))
+
+        for name, unit_name in _STROKE_PROPS.items():
+            if (value := _float(props.get(name))) > 0:
+                terms.append((value, props.get(unit_name, "MM")))
+
+        if (offset := props.get("offset")) is not None:
+            value = hypot(*(_float(v) for v in offset.split(",")))
+            if value > 0:
+                terms.append((value, props.get("offset_unit", "MM")))
+
+        for _, unit in terms:
+            if unit not in _UNIT_PIXELS and unit not in _MAP_UNITS:
+                known = False
+
+        # Sub-symbols are drawn relative to their parent symbol layers, for
+        # example markers of a marker line with an offset.
+        if (parent := next(layer.iterancestors("layer"), None)) is not None:
+            terms.extend(layers.get(parent, ()))
+
+        layers[layer] = terms
+
+    labels = _labels_enabled(root)
+    diagrams = _diagrams_enabled(root)
+
+    return SymbolExtent(list(layers.values()), known=known and not diagrams, labels=labels)
+
+
+class ExpressionError(ValueError):
+    pass
+
+
+_TOKEN = re.compile(
+    r"""\s*(?:
+    (?P<field>"(?:[^"]|"")*")
+    | (?P<string>'(?:[^']|'')*')
+    | (?P<number>\d+(?:\.\d*)?(?:[eE][-+]?\d+)?)
+    | (?P<op><>|!=|<=|>=|=|<|>|\(|\)|,|-)
+    | (?P<word>[A-Za-z_][A-Za-z0-9_]*)
+    )""",
+    re.VERBOSE,
+)
+
+_KEYWORDS = {"and", "or", "not", "in", "is", "like", "ilike", "null", "true", "false"}
+
+_COMPARISON = {"=": "==", "<>": "!=", "!=": "!=", "<": "<", "<=": "<=", ">": ">", ">=": ">="}
+_FLIPPED = {"==": "==", "!=": "!=", "<": ">", "<=": ">=", ">": "<", ">=": "<="}
+
+
+def _tokenize(expression):
+    pos, end = 0, len(expression)
+    result = list()
+    while pos < end:
+        if expression[pos:].strip() == "":
+            break
+        if (m := _TOKEN.match(expression, pos)) is None:
+            raise ExpressionError(f"Unexpected character at {pos}")
+        kind = m.lastgroup
+        value = m.group(kind)
+        if kind == "field":
+            value = value[1:-1].replace('""', '"')
+        elif kind == "string":
+            value = value[1:-1].replace("''", "'")
+        elif kind == "number":
+            value = float(value) if any(c in value for c in ".eE") else int(value)
+        elif kind == "word":
+            if value.lower() in _KEYWORDS:
+                kind, value = "keyword", value.lower()
+            else:
+                # Bare words are field names in QGIS expressions
+                kind = "field"
+        result.append((kind, value))
+        pos = m.end()
+    return result
+
+
+class _ExpressionParser:
+    def __init__(self, expression):
+        self.tokens = _tokenize(expression)
+        self.pos = 0
+
+    def parse(self):
+        result = self.disjunction()
+        if self.pos != len(self.tokens):
+            raise ExpressionError("Unexpected trailing tokens")
+        return result
+
+    def peek(self):
+        return self.tokens[self.pos] if self.pos < len(self.tokens) else (None, None)
+
+    def take(self, kind, value=None):
+        tkind, tvalue = self.peek()
+        if tkind != kind or (value is not None and tvalue != value):
+            raise ExpressionError(f"Expected {value or kind}")
+        self.pos += 1
+        return tvalue
+
+    def accept(self, kind, value):
+        if self.peek() == (kind, value):
+            self.pos += 1
+            return True
+        return False
+
+    def disjunction(self):
+        items = [self.conjunction()]
+        while self.accept("keyword", "or"):
+            items.append(self.conjunction())
+        return items[0] if len(items) == 1 else ["any", *items]
+
+    def conjunction(self):
+        items = [self.primary()]
+        while self.accept("keyword", "and"):
+            items.append(self.primary())
+        return items[0] if len(items) == 1 else ["all", *items]
+
+    def primary(self):
+        if self.accept("op", "("):
+            result = self.disjunction()
+            self.take("op", ")")
+            return result
+        return self.comparison()
+
+    def operand(self):
+        kind, value = self.peek()
+        if kind == "field":
+            self.pos += 1
+            return ["get", value]
+        return self.literal()
+
+    def literal(self):
+        negative = self.accept("op", "-")
+        kind, value = self.peek()
+        if kind == "number":
+            self.pos += 1
+            return -value if negative else value
+        elif kind == "string" and not negative:
+            self.pos += 1
+            return value
+        raise ExpressionError("Unsupported operand")
+
+    def comparison(self):
+        left = self.operand()
+
+        if self.accept("keyword", "in"):
+            if not isinstance(left, list):
+                raise ExpressionError("Field expected before IN")
+            self.take("op", "(")
+            values = [self.literal()]
+            while self.accept("op", ","):
+                values.append(self.literal())
+            self.take("op", ")")
+            items = [["==", left, v] for v in values]
+            return items[0] if len(items) == 1 else ["any", *items]
+
+        kind, value = self.peek()
+        if kind != "op" or value not in _COMPARISON:
+            raise ExpressionError("Comparison expected")
+        self.pos += 1
+        op = _COMPARISON[value]
+        right = self.operand()
+
+        if isinstance(left, list) and not isinstance(right, list):
+            return [op, left, right]
+        elif isinstance(right, list) and not isinstance(left, list):
+            return [_FLIPPED[op], right, left]
+        raise ExpressionError("Comparison of a field with a literal expected")
+
+
+def translate_expression(expression):
+    """Translate a simple QGIS expression into a feature filter
+
+    Only comparisons of fields with literals combined with AND, OR and IN
+    are supported, ExpressionError is raised for other expressions."""
+
+    return _ExpressionParser(expression).parse()
+
+
+class RuleFilter:
+    """Feature filters of rule-based renderer rules with symbols
+
+    Each rule is a tuple of filters, which should all match, and the minimum
+    and maximum scale denominators, where zero means unbounded."""
+
+    def __init__(self, rules):
+        self.rules = rules
+
+    def filter(self, denom):
+        """Alternative filters matching features drawn at the scale denominator
+
+        Returns None if any feature can be drawn and an empty list if no rules
+        are visible at the scale."""
+
+        items = list()
+        for filters, min_denom, max_denom in self.rules:
+            # Boundaries are extended a bit for rounding errors
+            if min_denom and denom < min_denom * 0.99:
+                continue
+            if max_denom and denom > max_denom * 1.01:
+                continue
+            if len(filters) == 0:
+                return None
+            item = filters[0] if len(filters) == 1 else ["all", *filters]
+            if item not in items:
+                items.append(item)
+        return items
+
+
+def _rule_denoms(rule, min_denom, max_denom):
+    # In QML scalemindenom is the lower and scalemaxdenom is the upper bound
+    if (value := _float(rule.get("scalemindenom"))) > 0:
+        min_denom = max(min_denom, value)
+    if (value := _float(rule.get("scalemaxdenom"))) > 0:
+        max_denom = min(max_denom, value) if max_denom else value
+    return min_denom, max_denom
+
+
+def _walk_rules(parent, filters, min_denom, max_denom, result):
+    for rule in parent.iterfind("./rule"):
+        if rule.get("checkstate") == "0":
+            continue
+
+        expression = rule.get("filter")
+        rule_filters = filters
+        if expression is not None and expression.strip() != "":
+            if expression.strip().upper() == "ELSE":
+                raise ExpressionError("ELSE rules aren't supported")
+            rule_filters = filters + (translate_expression(expression),)
+
+        rule_denoms = _rule_denoms(rule, min_denom, max_denom)
+        if rule.get("symbol") is not None:
+            result.append((rule_filters, *rule_denoms))
+        _walk_rules(rule, rule_filters, *rule_denoms, result)
+
+
+def rule_filter(qml):
+    """Extract feature filters from rule-based renderer of QML style string
+
+    Returns None if the renderer isn't rule-based or all features may be
+    drawn anyway, for example, due to labels or untranslatable rules."""
+
+    root = etree.fromstring(qml.encode("utf-8"))
+
+    renderer = root.find("./renderer-v2")
+    if renderer is None or renderer.get("type") != "RuleRenderer":
+        return None
+
+    # Labels and diagrams are drawn regardless of renderer rules
+    if _labels_enabled(root) or _diagrams_enabled(root):
+        return None
+
+    if (rules := renderer.find("./rules")) is None:
+        return None
+
+    result = list()
+    try:
+        _walk_rules(rules, (), 0, 0, result)
+    except ExpressionError:
+        return None
+
+    return RuleFilter(result)
+
+
+class SymbolFilter:
+    """Feature filters of renderer legend symbols by symbol index
+
+    Filter of a symbol is None if it may match any feature, for example, for
+    the category of all other values."""
+
+    def __init__(self, symbols):
+        self.symbols = symbols
+
+    def filter(self, indices):
+        """Alternative filters matching features drawn with given symbols
+
+        Returns None if any feature can be drawn and an empty list if none of
+        the symbols draw features."""
+
+        items = list()
+        for idx in indices:
+            if idx not in self.symbols:
+                continue
+            if (item := self.symbols[idx]) is None:
+                return None
+            if item not in items:
+                items.append(item)
+        return items
+
+
+_FIELD_NAME = re.compile(r'^(?:"((?:[^"]|"")+)"|([A-Za-z_][A-Za-z0-9_]*))$')
+
+
+def _renderer_field(renderer):
+    attr = (renderer.get("attr") or "").strip()
+    if (m := _FIELD_NAME.match(attr)) is None:
+        # Classification by an expression
+        return None
+    if m.group(1) is not None:
+        return m.group(1).replace('""', '"')
+    return m.group(2)
+
+
+def _category_filter(field, category):
+    values = [el.get("value") for el in category.iterfind("./val")]
+    if len(values) == 0:
+        values = [category.get("value")]
+
+    if any(v is None or v == "" for v in values):
+        # Category of all other values
+        return None
+
+    items = [["==", ["get", field], v] for v in values]
+    return items[0] if len(items) == 1 else ["any", *items]
+
+
+def _range_filter(field, range_):
+    try:
+        lower, upper = float(range_.get("lower")), float(range_.get("upper"))
+    except (TypeError, ValueError):
+        return None
+    return ["all", [">=", ["get", field], lower], ["<=", ["get", field], upper]]
+
+
+def _flat_rule_filter(rule):
+    expression = rule.get("filter")
+    if expression is None or expression.strip() == "":
+        return None
+    try:
+        return translate_expression(expression)
+    except ExpressionError:
+        # ELSE rules raise ExpressionError too
+        return None
+
+
+def symbol_filter(qml):
+    """Extract feature filters of legend symbols from QML style string
+
+    Categorized and graduated renderers are supported, as well as rule-based
+    renderers without nested rules. Returns None for other renderers and if
+    labels or diagrams are enabled."""
+
+    root = etree.fromstring(qml.encode("utf-8"))
+
+    if (renderer := root.find("./renderer-v2")) is None:
+        return None
+
+    if _labels_enabled(root) or _diagrams_enabled(root):
+        return None
+
+    rtype = renderer.get("type")
+    if rtype in ("categorizedSymbol", "graduatedSymbol"):
+        if (field := _renderer_field(renderer)) is None:
+            return None
+        if rtype == "categorizedSymbol":
+            elements = renderer.iterfind("./categories/category")
+            factory = _category_filter
+        else:
+            elements = renderer.iterfind("./ranges/range")
+            factory = _range_filter
+        symbols = {idx: factory(field, el) for idx, el in enumerate(elements)}
+    elif rtype == "RuleRenderer":
+        rules = renderer.findall("./rules/rule")
+        if any(rule.find("./rule") is not None for rule in rules):
+            return None
+        # Legend symbols are only created for rules with symbols
+        rules = [rule for rule in rules if rule.get("symbol") is not None]
+        symbols = {idx: _flat_rule_filter(rule) for idx, rule in enumerate(rules)}
+    else:
+        return None
+
+    return SymbolFilter(symbols)
@@ -0,0 +1,113 @@
+from array import array
+from sys import getsizeof
+from threading import Lock
+
+import shapely
+from cachetools import TTLCache
+from shapely import STRtree
+
+from .cache import MISSING, SingleFlight
+
+# Estimated memory consumed by a snapshot besides features
+SNAPSHOT_SIZE_OVERHEAD = 4 * 2**10
+
+# Estimated memory consumed by an envelope and a spatial index entry
+FEATURE_SIZE_OVERHEAD = 256
+
+
+class FeatureSnapshot:
+    """Features of a layer held in memory with a spatial index
+
+    Features are kept converted for QGIS: IDs and WKB offsets in arrays, WKB
+    in a single buffer, and attribute rows in a tuple. The index is built
+    over feature envelopes, so a query may return features not intersecting
+    the extent."""
+
+    __slots__ = ("qhl_fields", "typ_fields", "ids", "offsets", "wkb", "rows", "tree", "size")
+
+    def __init__(self, qhl_fields, typ_fields, features):
+        self.qhl_fields = qhl_fields
+        self.typ_fields = typ_fields
+
+        self.ids = array("q", (fid for fid, _, _ in features))
+        self.offsets = array("Q", (0,))
+        for _, wkb, _ in features:
+            self.offsets.append(self.offsets[-1] + len(wkb))
+        self.wkb = b"".join(wkb for _, wkb, _ in features)
+        self.rows = tuple(row for _, _, row in features)
+
+        geoms = shapely.from_wkb([wkb for _, wkb, _ in features])
+        self.tree = STRtree(shapely.envelope(geoms))
+
+        self.size = (
+            SNAPSHOT_SIZE_OVERHEAD
+            + getsizeof(self.ids)
+            + getsizeof(self.offsets)
+            + getsizeof(self.wkb)
+            + getsizeof(self.rows)
+            + sum(getsizeof(row) + sum(map(getsizeof, row)) for row in self.rows)
+            + FEATURE_SIZE_OVERHEAD * len(self.ids)
+        )
+
+    def query(self, extent):
+        idx = self.tree.query(shapely.box(*extent))
+        idx.sort()
+
+        ids, offsets, wkb, rows = self.ids, self.offsets, self.wkb, self.rows
+        return tuple((ids[i], wkb[offsets[i] : offsets[i + 1]], rows[i]) for i in idx)
+
+
+def _snapshot_size(snapshot):
+    return SNAPSHOT_SIZE_OVERHEAD if snapshot is None else snapshot.size
+
+
+class SnapshotCache:
+    """Thread-safe cache of feature snapshots bounded by estimated size
+
+    A snapshot is loaded after a layer has been requested a given number of
+    times within the TTL, and requests are counted for a limited number of
+    layers. Layers with too many features are remembered as not eligible for
+    snapshots."""
+
+    def __init__(self, maxsize, ttl, *, threshold, max_features, max_tracked):
+        self.threshold = threshold
+        self.max_features = max_features
+
+        self._cache = TTLCache(maxsize=maxsize, ttl=ttl, getsizeof=_snapshot_size)
+        self._requests = TTLCache(maxsize=max_tracked, ttl=ttl)
+        self._lock = Lock()
+        self._flight = SingleFlight()
+
+    def get(self, key, load):
+        """Get a snapshot or None if the layer isn't hot yet or not eligible
+
+        Function load(limit) returns (qhl_fields, typ_fields, features) or
+        None if the layer has more features than the limit."""
+
+        with self._lock:
+            if (snapshot := self._cache.get(key, MISSING)) is not MISSING:
+                return snapshot
+
+            requests = self._requests[key] = self._requests.get(key, 0) + 1
+            if requests < self.threshold:
+                return None
+
+        return self._flight(key, self._load, key, load)
+
+    def _load(self, key, load):
+        snapshot = None
+        if (data := load(self.max_features)) is not None:
+            snapshot = FeatureSnapshot(*data)
+            if snapshot.size > self._cache.maxsize:
+                snapshot = None
+
+        with self._lock:
+            self._cache[key] = snapshot
+            self._requests.pop(key, None)
+
+        return snapshot
+
+    def clear(self):
+        with self._lock:
+            self._cache.clear()
+            self._requests.clear()
@@ -0,0 +1,50 @@
+<!DOCTYPE qgis PUBLIC 'http://mrcc.com/qgis.dtd' 'SYSTEM'>
+<qgis styleCategories="Symbology" version="3.42.3-Münster" labelsEnabled="0">
+  <renderer-v2 type="RuleRenderer" enableorderby="0" referencescale="-1" symbollevels="0" forceraster="0">
+    <rules key="{root}">
+      <rule key="{group}" label="No symbol" filter="&quot;color&quot; IS NOT NULL"/>
+      <rule key="{red}" label="Red" filter="&quot;color&quot; = '#FF0000'" symbol="0"/>
+      <rule key="{green}" label="Green" filter="&quot;color&quot; = '#00FF00'" symbol="1"/>
+    </rules>
+    <symbols>
+      <symbol name="0" type="marker" alpha="1" force_rhr="0" clip_to_extent="1">
+        <layer enabled="1" locked="0" class="SimpleMarker" pass="0">
+          <Option type="Map">
+            <Option name="angle" type="QString" value="0"/>
+            <Option name="color" type="QString" value="255,0,0,255"/>
+            <Option name="horizontal_anchor_point" type="QString" value="1"/>
+            <Option name="name" type="QString" value="circle"/>
+            <Option name="offset" type="QString" value="0,0"/>
+            <Option name="offset_unit" type="QString" value="Pixel"/>
+            <Option name="outline_style" type="QString" value="no"/>
+            <Option name="outline_width" type="QString" value="0"/>
+            <Option name="outline_width_unit" type="QString" value="Pixel"/>
+            <Option name="scale_method" type="QString" value="diameter"/>
+            <Option name="size" type="QString" value="32"/>
+            <Option name="size_unit" type="QString" value="Pixel"/>
+            <Option name="vertical_anchor_point" type="QString" value="1"/>
+          </Option>
+        </layer>
+      </symbol>
+      <symbol name="1" type="marker" alpha="1" force_rhr="0" clip_to_extent="1">
+        <layer enabled="1" locked="0" class="SimpleMarker" pass="0">
+          <Option type="Map">
+            <Option name="angle" type="QString" value="0"/>
+            <Option name="color" type="QString" value="0,255,0,255"/>
+            <Option name="horizontal_anchor_point" type="QString" value="1"/>
+            <Option name="name" type="QString" value="circle"/>
+            <Option name="offset" type="QString" value="0,0"/>
+            <Option name="offset_unit" type="QString" value="Pixel"/>
+            <Option name="outline_style" type="QString" value="no"/>
+            <Option name="outline_width" type="QString" value="0"/>
+            <Option name="outline_width_unit" type="QString" value="Pixel"/>
+            <Option name="scale_method" type="QString" value="diameter"/>
+            <Option name="size" type="QString" value="32"/>
+            <Option name="size_unit" type="QString" value="Pixel"/>
+            <Option name="vertical_anchor_point" type="QString" value="1"/>
+          </Option>
+        </layer>
+      </symbol>
+    </symbols>
+  </renderer-v2>
+</qgis>
@@ -0,0 +1,124 @@
+from threading import Event, Thread
+from time import sleep
+
+import pytest
+
+from ..cache import DERIVED_MAXSIZE, SingleFlight, StyleCache
+
+
+def test_style_cache():
+    cache = StyleCache(100)
+    loaded = list()
+
+    def load(key, size):
+        def _load():
+            loaded.append(key)
+            return (key, size)
+
+        return _load
+
+    assert cache.get("a", load("a", 40)).style == "a"
+    assert cache.get("a", load("a", 40)).style == "a"
+    assert cache.get("b", load("b", 40)).style == "b"
+    assert loaded == ["a", "b"]
+
+    # Doesn't fit into the budget with both previous entries
+    cache.get("c", load("c", 40))
+    stats = cache.stats()
+    assert (stats.hits, stats.misses, stats.evictions) == (1, 3, 1)
+    assert (stats.entries, stats.size) == (2, 80)
+
+    # Too large for the whole cache
+    assert cache.get("d", load("d", 200)).style == "d"
+    assert cache.stats().entries == 2
+
+    cache.clear()
+    assert cache.stats().evictions == 1
+
+
+def test_style_cache_derive():
+    cache = StyleCache(100)
+    entry = cache.get("a", lambda: ("a", 40))
+
+    assert entry.derive("x", lambda style: style * 2, sizeof=len) == "aa"
+    assert entry.derive("x", lambda style: "unused") == "aa"
+    assert (entry.size, cache.stats().size) == (42, 42)
+
+    # Only a limited number of derived values is kept
+    for idx in range(DERIVED_MAXSIZE):
+        entry.derive(idx, lambda style: style, sizeof=len)
+    assert entry.derive("x", lambda style: "bb") == "bb"
+    assert entry.size == 40 + DERIVED_MAXSIZE - 1
+
+    # The entry is evicted when derived values don't fit into the budget
+    entry.derive("y", lambda style: "y" * 100, sizeof=len)
+    assert cache.stats().entries == 0
+
+
+def _run_flight(flight, fn, count):
+    results = [None] * count
+
+    def call(idx):
+        try:
+            results[idx] = flight("key", fn)
+        except Exception as exc:
+            results[idx] = exc
+
+    threads = [Thread(target=call, args=(idx,)) for idx in range(count)]
+    for thread in threads:
+        thread.start()
+    return threads, results
+
+
+def test_single_flight():
+    flight = SingleFlight(copy=list)
+    started, release = Event(), Event()
+    calls = list()
+
+    def fn():
+        calls.append(None)
+        started.set()
+        release.wait(5)
+        return [len(calls)]
+
+    threads, results = _run_flight(flight, fn, 1)
+    started.wait(5)
+    more, more_results = _run_flight(flight, fn, 3)
+
+    # Let other callers join the running call
+    sleep(0.2)
+    release.set()
+    for thread in threads + more:
+        thread.join(5)
+
+    # Waiting callers get copies of the leader result
+    assert calls == [None]
+    assert results + more_results == [[1]] * 4
+    assert len({id(r) for r in results + more_results}) == 4
+
+    # Next call after completion runs the function again
+    assert flight("key", fn) == [2]
+
+
+def test_single_flight_exception():
+    flight = SingleFlight()
+    started, release = Event(), Event()
+
+    def fn():
+        started.set()
+        release.wait(5)
+        raise ValueError("failed")
+
+    threads, results = _run_flight(flight, fn, 1)
+    started.wait(5)
+    more, more_results = _run_flight(flight, fn, 2)
+
+    sleep(0.2)
+    release.set()
+    for thread in threads + more:
+        thread.join(5)
+
+    assert all(isinstance(r, ValueError) for r in results + more_results)
+
+    with pytest.raises(ValueError):
+        flight("key", fn)
@@ -1,8 +1,35 @@
+import json
+from datetime import date, datetime, time
+from types import SimpleNamespace
+
 import pytest
+import transaction
+from PIL import Image
+
+from nextgisweb.env import DBSession, env
 
+from nextgisweb.core.exception import ValidationError
+from nextgisweb.feature_layer import FIELD_TYPE
+from nextgisweb.svg_marker_library import SVGMarkerLibrary
 from nextgisweb.vector_layer import VectorLayer
 
-from ..model import QgisStyleFormat, QgisVectorStyle, update_not_modified
+from ..model import (
+    QgisStyleFormat,
+    QgisVectorStyle,
+    ScaleRangeCache,
+    _cache_key,
+    _convert_date,
+    _convert_datetime,
+    _convert_json,
+    _convert_none,
+    _convert_time,
+    _parse_filter,
+    _resolve_filter,
+    _row_converter,
+    read_style_entry,
+    update_not_modified,
+)
+from ..qml import ExpressionError
 
 pytestmark = pytest.mark.usefixtures("ngw_resource_defaults")
 
@@ -54,3 +81,164 @@ def test_scale_range(point_layer_id, test_data, ngw_txn):
     assert sr_cache is not None
     assert sr_cache.min_scale_denom == 100000
     assert sr_cache.max_scale_denom == 10000
+
+
+def test_scale_range_reject(point_layer_id, test_data, ngw_env, ngw_txn, monkeypatch):
+    vl = VectorLayer.filter_by(id=point_layer_id).one()
+    qvs = QgisVectorStyle(parent=vl).from_file(test_data / "scale/100_10.qml").persist()
+    qvs.qgis_scale_range_cache = ScaleRangeCache(100000, 10000)
+    DBSession.flush()
+
+    def fail(*args, **kwargs):
+        raise AssertionError("Style isn't expected to be read")
+
+    monkeypatch.setattr("nextgisweb_qgis.model._read_style", fail)
+    monkeypatch.setattr(ngw_env.qgis, "qgis_init", fail)
+
+    # Out of the persisted scale range
+    req = qvs.render_request(vl.srs)
+    assert req.render_extent(vl.srs.tile_extent((0, 0, 0)), (256, 256)) is None
+
+
+def test_content_hash(point_layer_id, test_data, ngw_txn):
+    vl = VectorLayer.filter_by(id=point_layer_id).one()
+    qml = test_data / "zero" / "red-circle.qml"
+    qvs1 = QgisVectorStyle(parent=vl).from_file(qml).persist()
+    qvs2 = QgisVectorStyle(parent=vl).from_file(qml).persist()
+
+    ngw_txn.commit()
+
+    qvs1 = QgisVectorStyle.filter_by(id=qvs1.id).one()
+    qvs2 = QgisVectorStyle.filter_by(id=qvs2.id).one()
+    assert qvs1.qgis_fileobj_id != qvs2.qgis_fileobj_id
+    assert qvs1.qgis_content_hash is not None
+    assert _cache_key(qvs1) == _cache_key(qvs2)
+
+    # Same sources with different SVG marker libraries
+    lib1, lib2 = SVGMarkerLibrary().persist(), SVGMarkerLibrary().persist()
+    DBSession.flush()
+    lib2.tstamp = lib1.tstamp
+    qvs1.svg_marker_library, qvs2.svg_marker_library = lib1, lib2
+    DBSession.flush()
+    assert _cache_key(qvs1) != _cache_key(qvs2)
+
+    qvs2.from_file(test_data / "zero" / "marker.qml")
+    assert qvs2.qgis_content_hash is None
+
+
+def test_render_legend(point_layer_id, test_data, ngw_txn):
+    vl = VectorLayer.filter_by(id=point_layer_id).one()
+    qml = test_data / "zero" / "red-circle.qml"
+    qvs = QgisVectorStyle(parent=vl).from_file(qml).persist()
+    DBSession.flush()
+
+    env.qgis.style_cache.clear()
+    png = qvs.render_legend().getvalue()
+    assert qvs.render_legend().getvalue() == png
+
+    # Encoded legend is counted in the style cache budget
+    entry = read_style_entry(qvs)
+    assert entry.derive("legend_png", lambda style: None) == png
+    assert env.qgis.style_cache.stats().size == entry.size >= len(png)
+
+    # Legend images aren't shared between callers
+    im = qvs.render_legend_image()
+    assert qvs.render_legend_image() is not im
+    with Image.open(qvs.render_legend()) as decoded:
+        assert decoded.convert("RGBA").tobytes() == im.convert("RGBA").tobytes()
+
+
+def test_row_converter():
+    convert = _row_converter(
+        (
+            ("i", _convert_none),
+            ("d", _convert_date),
+            ("t", _convert_time),
+            ("dt", _convert_datetime),
+            ("j", _convert_json),
+        )
+    )
+    batch = [
+        dict(
+            i=1,
+            d=date(2024, 2, 29),
+            t=time(12, 30, 15),
+            dt=datetime(2024, 2, 29, 12, 30, 15),
+            j=dict(a=1),
+            extra="ignored",
+        ),
+        dict(i=None, d=None, t=None, dt=None, j=None, extra=None),
+    ]
+    rows = convert(batch)
+    assert rows[0][:4] == (1, (2024, 2, 29), (12, 30, 15), (2024, 2, 29, 12, 30, 15))
+    assert json.loads(rows[0][4]) == dict(a=1)
+    assert rows[1] == (None, None, None, None, None)
+
+    # Single field rows are still tuples
+    assert _row_converter((("i", _convert_none),))([dict(i=1)]) == [(1,)]
+
+    # No fields used by a style
+    assert _row_converter(())([dict(i=1), dict(i=2)]) == [(), ()]
+
+
+def test_resolve_filter():
+    fields = dict(
+        name=SimpleNamespace(keyname="Name", datatype=FIELD_TYPE.STRING),
+        pop=SimpleNamespace(keyname="Pop", datatype=FIELD_TYPE.INTEGER),
+    )
+
+    expr = ["all", ["==", ["get", "NAME"], "x"], [">=", ["get", "pop"], "100"]]
+    assert _resolve_filter(expr, fields) == [
+        "all",
+        ["==", ["get", "Name"], "x"],
+        [">=", ["get", "Pop"], 100],
+    ]
+
+    # String ordering depends on the database collation
+    with pytest.raises(ExpressionError):
+        _resolve_filter([">", ["get", "name"], "x"], fields)
+
+    with pytest.raises(ExpressionError):
+        _resolve_filter(["==", ["get", "missing"], "x"], fields)
+
+
+def test_parse_filter(ngw_data_path, ngw_txn):
+    vl = VectorLayer().persist().from_ogr(ngw_data_path / "two-points.geojson")
+    qvs = QgisVectorStyle(parent=vl).persist()
+    DBSession.flush()
+
+    feature_filter = ["all", ["==", ["get", "color"], "#FF0000"]]
+    req = qvs.render_request(vl.srs, dict(filter=feature_filter))
+    extent = vl.srs.tile_extent((0, 0, 0))
+
+    # The second render reuses the program parsed for the first one
+    assert req.render_extent(extent, (256, 256)) is not None
+    filter_program = _parse_filter(vl, feature_filter)
+    assert req.render_extent(extent, (256, 256)) is not None
+    assert _parse_filter(vl, feature_filter) is filter_program
+
+    # Programs parsed for previous fields aren't reused
+    vl.fields[0].keyname = "colour"
+    with pytest.raises(ValidationError):
+        _parse_filter(vl, feature_filter)
+    assert _parse_filter(vl, ["all", ["==", ["get", "colour"], "#FF0000"]]) is not None
+
+
+def test_parse_filter_transactions(two_point_layer_id):
+    feature_filter = ["all", ["==", ["get", "color"], "#FF0000"]]
+    with transaction.manager:
+        vl = VectorLayer.filter_by(id=two_point_layer_id).one()
+        qvs = QgisVectorStyle(parent=vl).persist()
+        DBSession.flush()
+        style_id = qvs.id
+        filter_program = _parse_filter(vl, feature_filter)
+
+    # Programs are cached across requests, so they must not depend on objects
+    # of the session they were parsed in
+    with transaction.manager:
+        qvs = QgisVectorStyle.filter_by(id=style_id).one()
+        vl = qvs.parent
+        assert _parse_filter(vl, feature_filter) is filter_program
+
+        req = qvs.render_request(vl.srs, dict(filter=feature_filter))
+        assert req.render_extent(vl.srs.tile_extent((0, 0, 0)), (256, 256)) is not None
@@ -1,3 +1,14 @@
+/*** Table: qgis_data_version ***/
+
+CREATE TABLE qgis_data_version (
+    resource_id integer NOT NULL,
+    version integer NOT NULL,
+    PRIMARY KEY (resource_id),
+    FOREIGN KEY (resource_id) REFERENCES resource (id) ON DELETE CASCADE
+);
+
+COMMENT ON TABLE qgis_data_version IS 'qgis';
+
 /*** Table: qgis_raster_style ***/
 
 CREATE TABLE qgis_raster_style (
@@ -6,6 +17,7 @@ CREATE TABLE qgis_raster_style (
     qgis_fileobj_id integer,
     qgis_sld_id integer,
     qgis_scale_range_cache jsonb,
+    qgis_content_hash character varying(32),
     PRIMARY KEY (id),
     CONSTRAINT qgis_format_check CHECK (CASE qgis_format
         WHEN 'default'
@@ -34,6 +46,7 @@ CREATE TABLE qgis_vector_style (
     qgis_fileobj_id integer,
     qgis_sld_id integer,
     qgis_scale_range_cache jsonb,
+    qgis_content_hash character varying(32),
     PRIMARY KEY (id),
     CONSTRAINT qgis_format_check CHECK (CASE qgis_format
         WHEN 'default'
@@ -0,0 +1,87 @@
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from time import monotonic
+
+import pytest
+from qgis_headless.util import image_stat
+from shapely.geometry import Point
+
+from ..pool import RenderJob, RenderPool, VectorSource
+
+data_path = Path(__file__).parent / "data"
+
+
+@pytest.fixture()
+def pool(tmp_path):
+    pool = RenderPool(
+        str(tmp_path / "render.sock"),
+        size=1,
+        timeout=60,
+        executable=None,
+        logging_level="CRITICAL",
+        svg_path=None,
+    )
+    yield pool
+    pool.shutdown()
+
+
+def render_job(size):
+    return RenderJob(
+        srid=3857,
+        style_key=("test", "circle-d256"),
+        style_xml=(data_path / "circle-d256.qml").read_text(),
+        source=VectorSource(
+            geometry_type="POINT",
+            fields=(),
+            features=((1, Point(0, 0).wkb, ()),),
+        ),
+        extent=(-1000, -1000, 1000, 1000),
+        size=size,
+    )
+
+
+def test_pool_render(pool):
+    im = pool.render(render_job((256, 256)))
+    assert im.size == (256, 256)
+    assert image_stat(im).blue.max == 255
+
+    im = pool.render(render_job((256, 256)), (64, 64, 192, 128))
+    assert im.size == (128, 64)
+
+
+def test_pool_timeout(pool):
+    # Rendering takes longer than that
+    pool.timeout = 1e-6
+    with pytest.raises(TimeoutError):
+        pool.render(render_job((256, 256)))
+
+    # Stuck processes are replaced for the following renders
+    pool.timeout = 60
+    assert pool.render(render_job((256, 256))) is not None
+
+
+def test_pool_timeout_queued(pool):
+    pool.render(render_job((256, 256)))
+    started = monotonic()
+    pool.render(render_job((256, 256)))
+    duration = monotonic() - started
+
+    # Time spent waiting for the only render process doesn't count
+    pool.timeout = max(3 * duration, 0.5)
+    with ThreadPoolExecutor(6) as executor:
+        futures = [executor.submit(pool.render, render_job((256, 256))) for i in range(6)]
+        for future in futures:
+            assert future.result() is not None
+
+
+def test_pool_address(ngw_env, tmp_path, monkeypatch):
+    if ngw_env.qgis.options["pool.socket"] is not None:
+        pytest.skip("Render server socket is configured")
+
+    monkeypatch.setenv("XDG_RUNTIME_DIR", str(tmp_path))
+    address = Path(ngw_env.qgis._pool_address())
+    assert address.parent.stat().st_mode & 0o777 == 0o700
+
+    address.parent.chmod(0o755)
+    with pytest.raises(RuntimeError):
+        ngw_env.qgis._pool_address()
@@ -0,0 +1,158 @@
+from math import sqrt
+from pathlib import Path
+
+import pytest
+
+from ..qml import (
+    ExpressionError,
+    rule_filter,
+    symbol_extent,
+    symbol_filter,
+    translate_expression,
+)
+
+data_path = Path(__file__).parent / "data"
+
+
+@pytest.mark.parametrize(
+    "qml, map_unit_size, pixels",
+    (
+        pytest.param("circle-d256.qml", 1, 128 * sqrt(2), id="pixel"),
+        pytest.param("two-points.qml", 1, 5 * sqrt(2) * 96 / 25.4, id="mm"),
+    ),
+)
+def test_symbol_extent(qml, map_unit_size, pixels):
+    sym_extent = symbol_extent((data_path / qml).read_text())
+    assert not sym_extent.labels
+    assert sym_extent.pixels(map_unit_size) == pytest.approx(pixels)
+
+
+def _symbol_renderer(*layers, symbol_type="line"):
+    return (
+        f'<renderer-v2 type="singleSymbol"><symbols><symbol type="{symbol_type}" name="0">'
+        + "".join(layers)
+        + "</symbol></symbols></renderer-v2>"
+    )
+
+
+def _symbol_qml(*layers):
+    return f"<qgis>{_symbol_renderer(*layers)}</qgis>"
+
+
+def _symbol_layer(cls, children="", **props):
+    options = "".join(f'<Option name="{k}" value="{v}"/>' for k, v in props.items())
+    return (
+        f'<layer class="{cls}" enabled="1"><Option type="Map">{options}</Option>{children}</layer>'
+    )
+
+
+def test_symbol_extent_bounds():
+    marker = _symbol_layer(
+        "SimpleMarker",
+        size=10,
+        size_unit="Pixel",
+        outline_width=1,
+        outline_width_unit="Pixel",
+        horizontal_anchor_point=0,
+    )
+    line = _symbol_layer(
+        "MarkerLine",
+        f'<symbol type="marker" name="@0@0">{marker}</symbol>',
+        offset="3,4",
+        offset_unit="Pixel",
+    )
+
+    # Anchored at the edge, so the full diagonal, stroke and parent offset
+    sym_extent = symbol_extent(_symbol_qml(line))
+    assert sym_extent.pixels(1) == pytest.approx(10 * sqrt(2) + 1 + 5)
+
+    sym_extent = symbol_extent(_symbol_qml(line, _symbol_layer("GeometryGenerator")))
+    assert sym_extent.pixels(1) is None
+
+
+def test_symbol_extent_renderer():
+    marker = _symbol_layer("SimpleMarker", size=10, size_unit="Pixel")
+
+    # Heatmaps are drawn without symbols
+    qml = '<qgis><renderer-v2 type="heatmapRenderer" radius="10" radius_unit="0"/></qgis>'
+    assert symbol_extent(qml).pixels(1) is None
+
+    # Displaced points are drawn away from their features
+    qml = (
+        '<qgis><renderer-v2 type="pointDisplacement" tolerance="3">'
+        + _symbol_renderer(marker, symbol_type="marker")
+        + "</renderer-v2></qgis>"
+    )
+    assert symbol_extent(qml).pixels(1) is None
+
+
+@pytest.mark.parametrize(
+    "expression, expected",
+    (
+        pytest.param(""""class" = 'primary'""", ["==", ["get", "class"], "primary"], id="eq"),
+        pytest.param("1 < a", [">", ["get", "a"], 1], id="flipped"),
+        pytest.param(
+            """a IN ('x', 'y''s') AND "b" >= -1.5""",
+            [
+                "all",
+                ["any", ["==", ["get", "a"], "x"], ["==", ["get", "a"], "y's"]],
+                [">=", ["get", "b"], -1.5],
+            ],
+            id="in-and",
+        ),
+        pytest.param("upper(a) = 'X'", None, id="function"),
+        pytest.param(""""a" IS NULL""", None, id="is-null"),
+        pytest.param('"a" = "b"', None, id="two-fields"),
+    ),
+)
+def test_translate_expression(expression, expected):
+    if expected is None:
+        with pytest.raises(ExpressionError):
+            translate_expression(expression)
+    else:
+        assert translate_expression(expression) == expected
+
+
+RULES_QML = """<qgis labelsEnabled="0">
+<renderer-v2 type="RuleRenderer"><rules key="root">
+<rule key="1" filter="&quot;class&quot; = 'primary'" symbol="0" scalemaxdenom="5000000"/>
+<rule key="2" filter="&quot;class&quot; = 'minor'" symbol="1" scalemaxdenom="50000"/>
+<rule key="3" symbol="2" checkstate="0"/>
+</rules></renderer-v2></qgis>"""
+
+
+def test_rule_filter():
+    rules = rule_filter(RULES_QML)
+    assert rules.filter(1e6) == [["==", ["get", "class"], "primary"]]
+    assert len(rules.filter(1e4)) == 2
+    assert rules.filter(1e7) == []
+
+    # ELSE rules depend on other rules
+    assert rule_filter(RULES_QML.replace('checkstate="0"', 'filter="ELSE"')) is None
+
+
+CATEGORIZED_QML = """<qgis labelsEnabled="0">
+<renderer-v2 type="categorizedSymbol" attr="&quot;kind&quot;"><categories>
+<category value="a" symbol="0" render="true"/>
+<category value="b" symbol="1" render="true"/>
+<category value="" symbol="2" render="true"/>
+</categories></renderer-v2></qgis>"""
+
+
+def test_symbol_filter():
+    symbols = symbol_filter(CATEGORIZED_QML)
+    assert symbols.filter((1,)) == [["==", ["get", "kind"], "b"]]
+    assert len(symbols.filter((0, 1))) == 2
+    assert symbols.filter(()) == []
+
+    # Category of all other values
+    assert symbols.filter((0, 2)) is None
+
+    assert symbol_filter(CATEGORIZED_QML.replace("&quot;kind&quot;", "upper(kind)")) is None
+
+
+def test_symbol_filter_rules():
+    # Rules without symbols don't have legend symbols
+    qml = RULES_QML.replace('key="1" ', 'key="0"/><rule key="1" ')
+    symbols = symbol_filter(qml)
+    assert symbols.filter((1,)) == [["==", ["get", "class"], "minor"]]
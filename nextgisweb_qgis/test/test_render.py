@@ -3,19 +3,25 @@ from pathlib import Path
 import pytest
 from qgis_headless.util import image_stat
 
+from nextgisweb.env import DBSession
+
+from nextgisweb.raster_layer import RasterLayer
+from nextgisweb.render.event import on_data_change
 from nextgisweb.vector_layer import VectorLayer
 
-from ..model import QgisVectorStyle
+from .. import model
+from ..model import QgisRasterStyle, QgisVectorStyle, _tile_blocks, render_composite
+from ..snapshot import SnapshotCache
 
 pytestmark = pytest.mark.usefixtures("ngw_resource_defaults")
 
 
 @pytest.fixture()
-def pad_req():
+def pad_req(ngw_txn):
     data_path = Path(__file__).parent / "data"
     vl = VectorLayer().persist().from_ogr(data_path / "center-west.geojson")
     style = QgisVectorStyle(parent=vl).from_file(data_path / "circle-d256.qml").persist()
-    style.qgis_fileobj_id = -1  # for cache reading
+    DBSession.flush()  # for cache reading
     return style.render_request(vl.srs)
 
 
@@ -25,7 +31,8 @@ def pad_req():
         pytest.param((1, 0, 0), (0, 0, 255, 255), id="zoom-1-in-tile"),
         pytest.param((1, 1, 0), (0, 0, 255, 255), id="zoom-1-near-tile"),
         pytest.param((2, 1, 1), (0, 0, 255, 255), id="zoom-2-in-tile"),
-        pytest.param((2, 2, 1), None, id="zoom-2-far-of-tile"),
+        pytest.param((2, 2, 1), (0, 0, 255, 255), id="zoom-2-near-tile"),
+        pytest.param((2, 3, 1), None, id="zoom-2-far-of-tile"),
     ),
 )
 def test_render_padding(tile, color, pad_req):
@@ -41,3 +48,241 @@ def test_render_padding(tile, color, pad_req):
     assert stat.red.max == r
     assert stat.green.max == g
     assert stat.blue.max == b
+
+
+@pytest.mark.parametrize(
+    "tile", ((1, 0, 0), (1, 1, 0), (2, 1, 1), (2, 2, 1), (2, 3, 1), (2, 0, 0))
+)
+def test_render_metatile(tile, pad_req, ngw_env):
+    expected = pad_req.render_tile(tile, 256)
+
+    with ngw_env.qgis.options.override({"metatile.size": 2}):
+        im = pad_req.render_tile(tile, 256)
+
+    if expected is None:
+        assert im is None
+        return
+
+    assert im.size == expected.size
+    assert image_stat(im).alpha.max == image_stat(expected).alpha.max
+
+
+def test_render_metatile_data_change(pad_req, ngw_env):
+    cache = ngw_env.qgis.metatile_cache
+
+    def siblings():
+        key = pad_req._render_key()
+        with cache.lock:
+            return [k[len(key) :] for k in cache if k[: len(key)] == key]
+
+    with ngw_env.qgis.options.override({"metatile.size": 2}):
+        pad_req.render_tile((1, 0, 0), 256)
+        assert (1, 256, 1, 0) in siblings()
+
+        # Siblings rendered before a data change in any process aren't used
+        on_data_change.fire(pad_req.style.parent)
+        assert siblings() == []
+
+
+def test_render_tiles(pad_req):
+    tiles = [(2, 1, 1), (2, 2, 1), (2, 3, 1), (2, 1, 2)]
+    expected = [pad_req.render_tile(tile, 256) for tile in tiles]
+    images = pad_req.render_tiles(tiles, 256)
+
+    assert len(images) == len(tiles)
+    for im, exp in zip(images, expected):
+        if exp is None:
+            assert im is None
+        else:
+            assert im.size == exp.size
+            assert image_stat(im).alpha.max == image_stat(exp).alpha.max
+
+
+@pytest.mark.parametrize(
+    "tiles, blocks",
+    (
+        pytest.param([(2, 0, 0), (2, 1, 0), (2, 0, 1), (2, 1, 1)], [[0, 1, 2, 3]], id="square"),
+        pytest.param([(2, 0, 0), (2, 3, 0)], [[0], [1]], id="row-gap"),
+        pytest.param([(2, 0, 0), (2, 1, 1), (2, 2, 2)], [[0], [1], [2]], id="diagonal"),
+        pytest.param([(2, 0, 0), (2, 0, 1), (2, 1, 1)], [[0], [1, 2]], id="corner"),
+        pytest.param([(2, 1, 1), (2, 1, 1)], [[0, 1]], id="duplicate"),
+    ),
+)
+def test_tile_blocks(tiles, blocks):
+    assert _tile_blocks(tiles) == blocks
+
+
+def test_render_composite(pad_req):
+    extent = pad_req.srs.tile_extent((1, 0, 0))
+    expected = pad_req.render_extent(extent, (256, 256))
+
+    im = render_composite([pad_req], extent, (256, 256))
+    assert im.size == expected.size
+    assert image_stat(im).alpha.max == image_stat(expected).alpha.max
+
+    far = pad_req.srs.tile_extent((2, 3, 1))
+    assert render_composite([pad_req, pad_req], far, (256, 256)) is None
+
+
+def test_render_composite_shared(pad_req, monkeypatch):
+    data_path = Path(__file__).parent / "data"
+    vl = pad_req.style.parent
+    style = QgisVectorStyle(parent=vl).from_file(data_path / "two-points.qml").persist()
+    DBSession.flush()
+    req = style.render_request(vl.srs)
+
+    extent = vl.srs.tile_extent((1, 0, 0))
+    expected = [r.render_extent(extent, (256, 256)) for r in (pad_req, req)]
+
+    queries = list()
+    query_features = QgisVectorStyle._query_features
+
+    def _query_features(self, *args, **kwargs):
+        queries.append(self.id)
+        return query_features(self, *args, **kwargs)
+
+    monkeypatch.setattr(QgisVectorStyle, "_query_features", _query_features)
+
+    # Both styles are rendered from features fetched once
+    im = render_composite([pad_req, req], extent, (256, 256))
+    assert len(queries) == 1
+
+    alpha = image_stat(im).alpha.max
+    assert alpha == max(image_stat(e).alpha.max for e in expected if e is not None)
+
+
+def test_render_symbols(two_point_layer_id, monkeypatch, ngw_txn):
+    data_path = Path(__file__).parent / "data"
+    vl = VectorLayer.filter_by(id=two_point_layer_id).one()
+    style = QgisVectorStyle(parent=vl).from_file(data_path / "two-points-rules.qml").persist()
+    DBSession.flush()
+
+    # The first rule doesn't have a symbol, so the second symbol is green
+    req = style.render_request(vl.srs, dict(symbols=[1]))
+    extent = vl.srs.tile_extent((0, 0, 0))
+    im = req.render_extent(extent, (256, 256))
+    assert im is not None
+
+    # Symbols filtered by QGIS only
+    monkeypatch.setattr(model, "_style_filter", lambda *args: None)
+    expected = req.render_extent(extent, (256, 256))
+    assert im.tobytes() == expected.tobytes()
+
+    stat = image_stat(im)
+    assert (stat.red.max, stat.green.max) == (0, 255)
+
+
+def test_render_empty_cache(pad_req, ngw_env):
+    cache = ngw_env.qgis.empty_cache
+
+    def cached():
+        key = pad_req._render_key()
+        with cache.lock:
+            return any(k[: len(key)] == key for k in cache)
+
+    far = pad_req.srs.tile_extent((2, 3, 1))
+    assert pad_req.render_extent(far, (256, 256)) is None
+    assert cached()
+
+    # Data versions are persisted, so other processes see the change too
+    on_data_change.fire(pad_req.style.parent)
+    assert not cached()
+
+
+def test_render_snapshot_data_change(pad_req, ngw_env, monkeypatch):
+    cache = SnapshotCache(1 << 20, 600, threshold=1, max_features=1000, max_tracked=16)
+    monkeypatch.setattr(ngw_env.qgis, "snapshot_cache", cache)
+
+    vl = pad_req.style.parent
+    snapshot = model._feature_snapshot(vl, None)
+    assert snapshot is not None
+    assert model._feature_snapshot(vl, None) is snapshot
+
+    # Data versions are persisted, so other processes see the change too
+    on_data_change.fire(vl)
+    assert model._feature_snapshot(vl, None) is not snapshot
+
+
+@pytest.mark.parametrize(
+    "layer_id, simplified",
+    (
+        pytest.param("point_layer_id", False, id="point"),
+        pytest.param("polygon_layer_id", True, id="polygon"),
+    ),
+)
+def test_render_simplify(layer_id, simplified, request, ngw_env, monkeypatch, ngw_txn):
+    vl = VectorLayer.filter_by(id=request.getfixturevalue(layer_id)).one()
+    req = QgisVectorStyle(parent=vl).persist().render_request(vl.srs)
+    DBSession.flush()
+
+    query = vl.feature_query()
+    query.geom()
+    bounds = [f.geom.shape.bounds for f in query()]
+    extent = (
+        min(b[0] for b in bounds) - 1000,
+        min(b[1] for b in bounds) - 1000,
+        max(b[2] for b in bounds) + 1000,
+        max(b[3] for b in bounds) + 1000,
+    )
+    expected = req.render_extent(extent, (256, 256))
+
+    tolerances = list()
+    query_simplify = type(query).simplify
+
+    def simplify(self, tolerance):
+        tolerances.append(tolerance)
+        return query_simplify(self, tolerance)
+
+    monkeypatch.setattr(type(query), "simplify", simplify)
+    with ngw_env.qgis.options.override({"simplify.tolerance": 0.5}):
+        im = req.render_extent(extent, (256, 256))
+
+    pixel_size = (extent[2] - extent[0]) / 256
+    assert tolerances == ([pytest.approx(pixel_size * 0.5)] if simplified else [])
+    assert image_stat(im).alpha.max == image_stat(expected).alpha.max
+
+
+def test_render_stats(pad_req, ngw_env, monkeypatch):
+    stats = ngw_env.qgis.render_stats
+    stats.clear()
+
+    pad_req.render_tile((1, 0, 0), 256)
+
+    item = stats.stats()[pad_req.style.id]
+    assert item.renders == 1
+    assert item.features == 1
+    assert item.phases["render"] > 0
+
+    # Callers waiting for a render of another caller don't record timing
+    monkeypatch.setattr(ngw_env.qgis, "render_flight", lambda key, fn, *a, **kw: None)
+    pad_req.render_tile((1, 1, 0), 256)
+    assert stats.stats()[pad_req.style.id].renders == 1
+
+
+def test_render_raster_footprint(raster_layer_id, ngw_txn):
+    rl = RasterLayer.filter_by(id=raster_layer_id).one()
+    req = QgisRasterStyle(parent=rl).persist().render_request(rl.srs)
+
+    minx, miny, maxx, maxy = rl.srs.tile_extent((0, 0, 0))
+    assert req.render_extent((minx, miny, minx + 1, miny + 1), (256, 256)) is None
+    assert req.render_tile((0, 0, 0), 256) is not None
+
+
+def test_render_raster_composite(raster_layer_id, ngw_txn):
+    rl = RasterLayer.filter_by(id=raster_layer_id).one()
+    reqs = [QgisRasterStyle(parent=rl).persist().render_request(rl.srs) for i in range(2)]
+
+    style = reqs[0].style
+    extent = style._footprint(rl.srs).bounds
+    expected = reqs[0].render_extent(extent, (256, 256))
+    assert expected is not None
+
+    # Each style of the same raster gets its own QGIS layer
+    im = render_composite(reqs, extent, (256, 256))
+    assert image_stat(im).alpha.max == image_stat(expected).alpha.max
+
+    # Layers are borrowed exclusively and reused by following renders
+    with style._qgis_layer() as layer, style._qgis_layer() as other:
+        assert layer is not other
+    with style._qgis_layer() as reused:
+        assert reused is layer or reused is other
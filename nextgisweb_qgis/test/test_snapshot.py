@@ -0,0 +1,49 @@
+from shapely.geometry import LineString, Point
+
+from ..snapshot import FeatureSnapshot, SnapshotCache
+
+
+def test_snapshot_cache():
+    features = (
+        (1, Point(0, 0).wkb, ()),
+        (2, Point(10, 10).wkb, ()),
+        (3, LineString([(0, 10), (10, 0)]).wkb, ()),
+    )
+    cache = SnapshotCache(2**20, 60, threshold=2, max_features=3, max_tracked=16)
+    loaded = list()
+
+    def load(limit):
+        loaded.append(limit)
+        return ((), (), features)
+
+    # Not hot yet
+    assert cache.get("a", load) is None
+    assert loaded == []
+
+    snapshot = cache.get("a", load)
+    assert cache.get("a", load) is snapshot
+    assert loaded == [3]
+
+    assert [f[0] for f in snapshot.query((-1, -1, 1, 1))] == [1, 3]
+    assert [f[0] for f in snapshot.query((9, 9, 11, 11))] == [2, 3]
+    assert snapshot.query((20, 20, 30, 30)) == ()
+
+    # Not eligible layers are remembered
+    assert cache.get("b", lambda limit: None) is None
+    assert cache.get("b", lambda limit: None) is None
+    assert cache.get("b", load) is None
+    assert cache.get("b", load) is None
+    assert loaded == [3]
+
+
+def test_feature_snapshot():
+    features = (
+        (1, Point(0, 0).wkb, ("a",)),
+        (2, LineString([(0, 0), (10, 10)]).wkb, ("b" * 1000,)),
+    )
+    snapshot = FeatureSnapshot((), (), features)
+    assert snapshot.query((-1, -1, 11, 11)) == features
+
+    # Attribute values are accounted
+    small = FeatureSnapshot((), (), features[:1] + ((2, features[1][1], ("b",)),))
+    assert snapshot.size - small.size >= 999
@@ -0,0 +1,35 @@
+from ..util import bgra_to_pil, bgra_transparent
+
+
+def test_bgra_transparent():
+    assert bgra_transparent(bytes(4 * 16))
+    assert bgra_transparent(bytes([255, 255, 255, 0] * 16))
+
+    data = bytearray(4 * 16)
+    data[-1] = 1
+    assert not bgra_transparent(data)
+    assert not bgra_transparent(memoryview(data))
+
+
+def test_bgra_to_pil():
+    width, height = 4, 3
+
+    # Blue and green channels encode pixel column and row
+    data = bytearray()
+    for y in range(height):
+        for x in range(width):
+            data.extend((x, y, 200, 255))
+
+    im = bgra_to_pil(data, (width, height))
+    assert im.mode == "RGBA"
+    assert im.size == (width, height)
+    assert im.getpixel((3, 2)) == (200, 2, 3, 255)
+
+    im = bgra_to_pil(memoryview(data), (width, height), (1, 1, 3, 3))
+    assert im.size == (2, 2)
+    assert [im.getpixel((x, y)) for y in range(2) for x in range(2)] == [
+        (200, 1, 1, 255),
+        (200, 1, 2, 255),
+        (200, 2, 1, 255),
+        (200, 2, 2, 255),
+    ]
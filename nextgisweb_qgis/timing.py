@@ -0,0 +1,143 @@
+from contextlib import contextmanager
+from contextvars import ContextVar
+from threading import Lock
+from time import perf_counter
+
+from msgspec import Struct
+from pyramid.threadlocal import get_current_request
+
+PHASES = ("style", "filter", "fetch", "layer", "render", "image")
+
+_current = ContextVar("qgis_render_timing", default=None)
+
+
+class RenderTiming:
+    """Durations of render phases and counters of a single render"""
+
+    __slots__ = ("total", "phases", "features", "bytes")
+
+    def __init__(self):
+        self.total = 0.0
+        self.phases = dict.fromkeys(PHASES, 0.0)
+        self.features = 0
+        self.bytes = 0
+
+
+@contextmanager
+def render_timing():
+    """Collect timing of render phases executed within the context"""
+
+    timing = RenderTiming()
+    token = _current.set(timing)
+    start = perf_counter()
+    try:
+        yield timing
+    finally:
+        timing.total = perf_counter() - start
+        _current.reset(token)
+
+
+@contextmanager
+def render_phase(name):
+    """Measure duration of a render phase if timing is being collected"""
+
+    if (timing := _current.get()) is None:
+        yield
+        return
+
+    start = perf_counter()
+    try:
+        yield
+    finally:
+        timing.phases[name] += perf_counter() - start
+
+
+def count_features(features):
+    """Count fetched features and their WKB size"""
+
+    if (timing := _current.get()) is not None:
+        timing.features += len(features)
+        timing.bytes += sum(len(wkb) for _, wkb, _ in features)
+
+
+class RenderStatsItem(Struct, kw_only=True):
+    renders: int
+    total: float
+    phases: dict[str, float]
+    features: int
+    bytes: int
+
+
+class RenderStats:
+    """Thread-safe aggregates of render timings by style
+
+    Statistics are collected in the current process only, so each process
+    has its own statistics."""
+
+    def __init__(self):
+        self._lock = Lock()
+        self._items = dict()
+
+    def record(self, key, timing):
+        with self._lock:
+            if (item := self._items.get(key)) is None:
+                item = self._items[key] = RenderStatsItem(
+                    renders=0,
+                    total=0.0,
+                    phases=dict.fromkeys(PHASES, 0.0),
+                    features=0,
+                    bytes=0,
+                )
+
+            item.renders += 1
+            item.total += timing.total
+            for name, value in timing.phases.items():
+                item.phases[name] += value
+            item.features += timing.features
+            item.bytes += timing.bytes
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+
+    def stats(self):
+        with self._lock:
+            return {
+                key: RenderStatsItem(
+                    renders=item.renders,
+                    total=item.total,
+                    phases=dict(item.phases),
+                    features=item.features,
+                    bytes=item.bytes,
+                )
+                for key, item in self._items.items()
+            }
+
+
+def add_server_timing(timing):
+    """Add render phase durations to Server-Timing header of the current
+    request response, durations of multiple renders are summed up"""
+
+    if (request := get_current_request()) is None:
+        return
+
+    total = request.__dict__.get("_qgis_render_timing")
+    if total is None:
+        total = request._qgis_render_timing = RenderTiming()
+        request.add_response_callback(_server_timing_callback)
+
+    total.total += timing.total
+    for name, value in timing.phases.items():
+        total.phases[name] += value
+
+
+def _server_timing_callback(request, response):
+    total = request._qgis_render_timing
+    metrics = [f"qgis;dur={total.total * 1000:.1f}"]
+    metrics.extend(
+        f"qgis-{name};dur={value * 1000:.1f}" for name, value in total.phases.items() if value > 0
+    )
+
+    if existing := response.headers.get("Server-Timing"):
+        metrics.insert(0, existing)
+    response.headers["Server-Timing"] = ", ".join(metrics)
@@ -4,6 +4,7 @@ from random import Random
 
 from lxml import etree
 from lxml.builder import ElementMaker
+from PIL import Image
 
 from nextgisweb.sld import NSMAP as nsmap_sld
 
@@ -94,3 +95,21 @@ def file_md5_hexdigest(file):
         while buf := f.read(4096):
             h.update(buf)
     return h.hexdigest()
+
+
+def bgra_transparent(data):
+    """Check if all pixels of BGRA or RGBA image data are fully transparent"""
+    return not bytes(data[3::4]).strip(b"\x00")
+
+
+def bgra_to_pil(data, size, box=None):
+    """Decode BGRA image data of the given size into PIL RGBA image
+
+    If the crop box is given, only its rows are decoded from a view of the
+    source buffer, so pixels are copied once without a full-size image."""
+
+    width, height = size
+    left, top, right, bottom = (0, 0, width, height) if box is None else box
+    stride = width * 4
+    view = memoryview(data)[top * stride + left * 4 :]
+    return Image.frombytes("RGBA", (right - left, bottom - top), view, "raw", "BGRA", stride, 1)